@@ -0,0 +1,168 @@
+"""
+Offline benchmark for the equity hot path (no Telegram or Mongo needed).
+
+Runs the engine behind calculate_probability_and_advice (HandState + calculate_hand_equity,
+without the result cache) for every street against 1..9 opponents, plus parse_card_input,
+and reports hands evaluated per second, p50/p99 latency and peak traced memory:
+
+    python benchmark-equity.py --save-baseline equity-baseline.json
+    python benchmark-equity.py --baseline equity-baseline.json --tolerance 0.15
+
+With --baseline the run fails (exit code 1) when the throughput of any case drops by more
+than the tolerance. Baselines are only comparable on the same machine and settings.
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import equity
+from equity import INDEX_TO_CARD, HandState, calculate_hand_equity, parse_card_input
+
+STREETS = {"preflop": 0, "flop": 3, "turn": 4, "river": 5}
+CARD_INPUTS = ["Ah", "kd", "10s", " 7c ", "Tc", "2h", "qs", "9D"]
+
+
+class CountingEvaluator:
+    """Wraps equity.evaluate_masks to count the hands it ranks."""
+
+    def __init__(self, evaluate):
+        self.evaluate = evaluate
+        self.hands = 0
+
+    def __call__(self, masks):
+        self.hands += np.size(masks)
+        return self.evaluate(masks)
+
+
+def percentile(samples, q):
+    return float(np.percentile(samples, q)) if samples else 0.0
+
+
+def random_spot(rng, board_size):
+    cards = rng.choice(52, size=2 + board_size, replace=False)
+    return [INDEX_TO_CARD[i] for i in cards[:2]], [INDEX_TO_CARD[i] for i in cards[2:]]
+
+
+def run_equity_case(street, opponent_count, args, counter):
+    """Times `args.repeats` calculations on random spots of one street, and one more under tracemalloc."""
+    rng = np.random.default_rng(args.seed)
+    ranges = [args.range] * opponent_count if args.range else None
+    latencies = []
+    counter.hands = 0
+    for _ in range(args.repeats):
+        hole_cards, community_cards = random_spot(rng, STREETS[street])
+        start = time.perf_counter()
+        calculate_hand_equity(HandState(hole_cards, community_cards), opponent_count, args.simulations,
+                              np.random.default_rng(args.seed), ranges=ranges)
+        latencies.append(time.perf_counter() - start)
+    hands = counter.hands
+
+    hole_cards, community_cards = random_spot(rng, STREETS[street])
+    tracemalloc.start()
+    calculate_hand_equity(HandState(hole_cards, community_cards), opponent_count, args.simulations,
+                          np.random.default_rng(args.seed), ranges=ranges)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    total = sum(latencies)
+    return {
+        "calls_per_second": len(latencies) / total,
+        "hands_per_second": hands / total,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "peak_memory_mb": peak / 2 ** 20,
+    }
+
+
+def run_parse_case(args):
+    """parse_card_input, timed in batches of 1000 calls."""
+    latencies = []
+    for _ in range(args.repeats):
+        start = time.perf_counter()
+        for i in range(1000):
+            parse_card_input(CARD_INPUTS[i % len(CARD_INPUTS)])
+        latencies.append((time.perf_counter() - start) / 1000)
+    return {
+        "calls_per_second": len(latencies) / sum(latencies),
+        "hands_per_second": 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "peak_memory_mb": 0.0,
+    }
+
+
+def throughput(case):
+    """Hands per second for the engine, calls per second where nothing is evaluated (preflop table, parsing)."""
+    return case["hands_per_second"] or case["calls_per_second"]
+
+
+def compare(results, baseline, tolerance):
+    """Returns the cases whose throughput dropped more than `tolerance` below the baseline."""
+    if baseline["settings"] != results["settings"]:
+        print(f"Warning: baseline settings differ: {baseline['settings']}")
+    regressions = []
+    for name, case in results["cases"].items():
+        reference = baseline["cases"].get(name)
+        if reference is None or not throughput(reference):
+            continue
+        change = throughput(case) / throughput(reference) - 1
+        if change < -tolerance:
+            regressions.append((name, change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the equity engine")
+    parser.add_argument("--streets", nargs="+", choices=list(STREETS), default=list(STREETS))
+    parser.add_argument("--opponents", type=int, nargs="+", default=list(range(1, 10)))
+    parser.add_argument("--repeats", type=int, default=10, help="calculations per case")
+    parser.add_argument("--simulations", type=int, default=equity.DEFAULT_SIMULATIONS,
+                        help="Monte Carlo deals per calculation")
+    parser.add_argument("--range", help="opponent range for every opponent, e.g. 'top 20%%'")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", help="JSON baseline to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed relative throughput drop")
+    parser.add_argument("--save-baseline", help="write the results as a JSON baseline")
+    args = parser.parse_args()
+
+    counter = CountingEvaluator(equity.evaluate_masks)
+    equity.evaluate_masks = counter
+    equity.warm_up()
+
+    results = {
+        "settings": {"repeats": args.repeats, "simulations": args.simulations, "range": args.range, "seed": args.seed},
+        "machine": {"python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform()},
+        "cases": {},
+    }
+    print(f"{'case':<16} {'hands/s':>12} {'calls/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'peak MB':>8}")
+    cases = [("parse_card_input", None, None)]
+    cases += [(f"{street}-{count}", street, count) for street in args.streets for count in args.opponents]
+    for name, street, opponent_count in cases:
+        case = run_parse_case(args) if street is None else run_equity_case(street, opponent_count, args, counter)
+        results["cases"][name] = case
+        print(f"{name:<16} {case['hands_per_second']:>12,.0f} {case['calls_per_second']:>10,.1f} "
+              f"{case['p50_ms']:>9.3f} {case['p99_ms']:>9.3f} {case['peak_memory_mb']:>8.1f}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, change in regressions:
+            print(f"REGRESSION {name}: throughput {change:+.1%}")
+        if regressions:
+            sys.exit(1)
+        print(f"No throughput regressions beyond {args.tolerance:.0%}")
+
+
+if __name__ == '__main__':
+    main()
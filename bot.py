@@ -1,14 +1,27 @@
+import time
+PROCESS_STARTED = time.monotonic()  # for the cold-start report
+
 import os
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from datetime import datetime
 from pymongo import MongoClient
-from telegram import Update, error
-from telegram.ext import Application, CommandHandler, CallbackContext, ContextTypes, MessageHandler, filters
+from bson import ObjectId
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, error
+from telegram.constants import MessageLimit
+from telegram.ext import (Application, CallbackContext, CallbackQueryHandler, CommandHandler, ContextTypes,
+                          MessageHandler, filters)
 import json
-from treys import Card, Deck, Evaluator
+from treys import Card, Evaluator
 import threading
 from http.server import BaseHTTPRequestHandler, HTTPServer
-import tempfile
-from ultralytics import YOLO
+from detector import CardDetectionService, DetectionCache, DetectorBusy, load_card_model
+from repository import GameRepository
+from sessions import UNSET, SessionStore
+from equity import (EquityCache, HandState, calculate_hand_equity, equity_cache_key, is_random_range, parse_card_input,
+                    parse_range, warm_up)
 
 # נתיב הבסיס: מחושב אוטומטית לפי מיקום bot.py
 base_dir = os.path.dirname(os.path.abspath(__file__))
@@ -17,88 +30,113 @@ os.chdir(base_dir)  # Set the current working directory to base_dir
 # הגדרות קבועות ומידע חסוי ממשתני סביבה
 TOKEN = os.getenv("BOT_TOKEN")
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017/mydatabase")
-
-# התחברות למסד הנתונים
-print(f"Connecting to MongoDB at {MONGO_URI}")
-client = MongoClient(MONGO_URI)
-db = client['poker_bot']
-players_collection = db['players']
-games_collection = db['games']
-print(f"Db connection established")
+NUM_SIMULATIONS = int(os.getenv("EQUITY_SIMULATIONS", "500000"))  # upper bound per calculation
+EQUITY_TARGET_STDERR = float(os.getenv("EQUITY_TARGET_STDERR", "0.2"))  # percent
+EQUITY_TIME_BUDGET = float(os.getenv("EQUITY_TIME_BUDGET", "2"))  # seconds
+EQUITY_PROGRESSIVE = os.getenv("EQUITY_PROGRESSIVE", "0") == "1"  # quick estimate first, then edit the message
+EQUITY_QUICK_SIMULATIONS = int(os.getenv("EQUITY_QUICK_SIMULATIONS", "5000"))
+EQUITY_CACHE_ENTRIES = int(os.getenv("EQUITY_CACHE_ENTRIES", "5000"))
+EQUITY_CACHE_MB = int(os.getenv("EQUITY_CACHE_MB", "32"))
+EQUITY_CACHE_TTL = float(os.getenv("EQUITY_CACHE_TTL", "86400"))  # seconds
+EQUITY_WORKERS = int(os.getenv("EQUITY_WORKERS", "2"))  # 0 = run in a thread of the bot process
+EQUITY_TIMEOUT = float(os.getenv("EQUITY_TIMEOUT", "15"))  # seconds
+CARD_MODEL_PATH = os.getenv("CARD_MODEL_PATH", "./yolov8s_playing_cards-1.pt")  # .pt (ultralytics) or exported .onnx
+DETECTOR_BATCH_SIZE = int(os.getenv("DETECTOR_BATCH_SIZE", "8"))  # photos per model call
+DETECTOR_BATCH_WINDOW_MS = float(os.getenv("DETECTOR_BATCH_WINDOW_MS", "5"))  # wait for more photos before a call
+DETECTOR_QUEUE_SIZE = int(os.getenv("DETECTOR_QUEUE_SIZE", "32"))  # photos waiting before new ones are refused
+DETECTOR_CONTOUR_COUNT = os.getenv("DETECTOR_CONTOUR_COUNT", "0") == "1"  # also cap the cards by an OpenCV outline count
+DETECTOR_IMAGE_SIZE = int(os.getenv("DETECTOR_IMAGE_SIZE", "640"))  # downscale photos to this side, 0 = full size
+DETECTOR_CROP_TABLE = os.getenv("DETECTOR_CROP_TABLE", "0") == "1"  # crop photos to the table felt first
+DETECTION_CACHE_ENTRIES = int(os.getenv("DETECTION_CACHE_ENTRIES", "2000"))  # detected photos remembered, 0 = off
+# -1 = by file id only, 0 = also an identical photo uploaded again in the same chat (no larger distance)
+DETECTION_CACHE_HASH_DISTANCE = int(os.getenv("DETECTION_CACHE_HASH_DISTANCE", "-1"))
+DETECTION_CACHE_PERSIST = os.getenv("DETECTION_CACHE_PERSIST", "0") == "1"  # keep detected photos in MongoDB
+SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", "1"))  # seconds between writes of game changes
+SESSION_IDLE_TIMEOUT = float(os.getenv("SESSION_IDLE_TIMEOUT", "1800"))  # seconds before an idle chat leaves memory
+DB_QUERY_AUDIT = os.getenv("DB_QUERY_AUDIT", "0") == "1"  # explain the bot's queries at startup
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "50"))  # reported by the query audit
+DB_MAX_POOL_SIZE = int(os.getenv("DB_MAX_POOL_SIZE", "20"))  # connections per MongoDB server
+DB_MIN_POOL_SIZE = int(os.getenv("DB_MIN_POOL_SIZE", "1"))  # kept open while idle
+DB_MAX_IDLE_MS = int(os.getenv("DB_MAX_IDLE_MS", "60000"))  # an idle connection above the minimum is closed
+DB_TIMEOUT_MS = int(os.getenv("DB_TIMEOUT_MS", "5000"))  # deadline of one database operation
+DB_SLOW_TIMEOUT_MS = int(os.getenv("DB_SLOW_TIMEOUT_MS", "30000"))  # for index builds and whole-history statistics
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "10"))  # games per /history page
+
+# all games, players and statistics go through the asyncio client of the repository (connected on first use)
+repository = GameRepository(
+    MONGO_URI,
+    max_pool_size=DB_MAX_POOL_SIZE,
+    min_pool_size=DB_MIN_POOL_SIZE,
+    max_idle_ms=DB_MAX_IDLE_MS,
+    timeout_ms=DB_TIMEOUT_MS,
+    slow_timeout_ms=DB_SLOW_TIMEOUT_MS,
+)
+
+# the active game and players of every chat, in memory and written back in the background (started in post_init)
+sessions = SessionStore(repository, flush_interval=SESSION_FLUSH_INTERVAL, idle_timeout=SESSION_IDLE_TIMEOUT)
+
+# the detection cache is persisted from the detector thread, with a synchronous client connected on first use
+_database = None
+_database_lock = threading.Lock()
+
+def get_database():
+    """ מחזירה את מסד הנתונים, ומתחברת אליו בקריאה הראשונה """
+    global _database
+    with _database_lock:
+        if _database is None:
+            print(f"Connecting to MongoDB at {MONGO_URI}")
+            started = time.perf_counter()
+            _database = MongoClient(MONGO_URI, maxPoolSize=2, timeoutMS=DB_TIMEOUT_MS)['poker_bot']
+            print(f"Db connection established ({time.perf_counter() - started:.2f}s)")
+        return _database
+
+class LazyCollection:
+    """ Collection handle that connects to MongoDB on first use """
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attribute):
+        return getattr(get_database()[self.name], attribute)
+
+detection_cache_collection = LazyCollection('detection_cache')
+
+# the last query audit, shown in /summary
+query_audit = []
 
 
 # ==========================
 # Card identification logic
 # ==========================
-import cv2
-
-def count_cards(image_path):
-    # Load the image
-    image = cv2.imread(image_path)
-    original_image = image.copy()
-    
-    # Convert to grayscale
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    
-    # Apply Gaussian Blur to reduce noise
-    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-    
-    # Apply Canny Edge Detection
-    edges = cv2.Canny(blurred, threshold1=30, threshold2=150)
-    
-    # Find contours
-    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    
-    # Filter contours based on area and aspect ratio
-    card_contours = []
-    for contour in contours:
-        area = cv2.contourArea(contour)
-        if area > 1000:  # Filter out small contours
-            # Approximate the contour to reduce the number of points
-            perimeter = cv2.arcLength(contour, True)
-            approx = cv2.approxPolyDP(contour, 0.02 * perimeter, True)
-            
-            # Check if the contour has 4 sides (rectangle-like shape)
-            if len(approx) == 4:
-                card_contours.append(contour)
-
-    # Draw bounding boxes around detected cards for visualization
-    for contour in card_contours:
-        x, y, w, h = cv2.boundingRect(contour)
-        cv2.rectangle(original_image, (x, y), (x + w, y + h), (0, 255, 0), 2)
-
-    return len(card_contours)
-
-def get_distinct_identified_cards(model_card, image_path):
-    results = model_card(image_path)
-    
-    card_confidences = []
-    for result in results:
-        if result.boxes:
-            for box in result.boxes:
-                card_label = result.names[int(box.cls)]
-                confidence = box.conf  # Confidence score for the detection
-                print (f"Identified card: {card_label} with confidence: {confidence}")
-                card_confidences.append((card_label, confidence))
-    
-    num_cards = count_cards(image_path)  # Count the total number of cards
-                
-    # Sort by confidence score in descending order 
-    sorted_detections = sorted(card_confidences, key=lambda x: x[1], reverse=True)
-    # Extract unique card labels, limited by `num_cards`
-    distinct_cards = []
-    seen_cards = set()
-    for card_label, confidence in sorted_detections:
-        if card_label not in seen_cards:
-            distinct_cards.append(card_label)
-            seen_cards.add(card_label)
-        # Stop once we reach the desired number of cards
-        if len(distinct_cards) >= num_cards:
-            break
-    
-    return distinct_cards
-
-card_model = YOLO("./yolov8s_playing_cards-1.pt")  # Model for identifying cards
+# cards already detected on a photo, so a resent or forwarded photo is not downloaded or detected again
+detection_cache = DetectionCache(
+    max_entries=DETECTION_CACHE_ENTRIES,
+    match_similar=DETECTION_CACHE_HASH_DISTANCE >= 0,
+    collection=detection_cache_collection if DETECTION_CACHE_PERSIST else None,
+) if DETECTION_CACHE_ENTRIES > 0 else None
+
+# photos from all chats go through one detector thread, in micro-batches (started in main).
+# The thread loads and warms up the model first, text commands do not wait for it.
+card_detector = CardDetectionService(
+    partial(load_card_model, CARD_MODEL_PATH),
+    max_batch=DETECTOR_BATCH_SIZE,
+    batch_window=DETECTOR_BATCH_WINDOW_MS / 1000,
+    max_queue=DETECTOR_QUEUE_SIZE,
+    use_contours=DETECTOR_CONTOUR_COUNT,
+    image_size=DETECTOR_IMAGE_SIZE,
+    crop_table=DETECTOR_CROP_TABLE,
+    cache=detection_cache,
+)
+
+def pick_photo_size(photo_sizes):
+    """
+    The smallest of Telegram's copies of a photo that still covers the model input size, so
+    less is downloaded and decoded. Cropping to the table needs the detail of the largest one.
+    """
+    if DETECTOR_IMAGE_SIZE and not DETECTOR_CROP_TABLE:
+        for photo_size in photo_sizes:  # ordered from small to large
+            if max(photo_size.width, photo_size.height) >= DETECTOR_IMAGE_SIZE:
+                return photo_size
+    return photo_sizes[-1]
 
 # ==========================
 # Web server for summary
@@ -125,85 +163,57 @@ def start_summary_server():
 # ========================================
 # Data access and general utlity functions
 # ========================================
-def parse_card_input(card_str):
-    """ממירה את הקלט של הקלף לפורמט מתאים """
-    
-    # המרה לאותיות גדולות וניקוי רווחים
-    card_str = card_str.strip().upper()
-
-    # המרה של "10" ל-"T" כדי להתאים לפורמט של STR_RANKS
-    card_str = card_str.replace("10", "T")
-
-    # בדיקת תקינות פורמט הקלט
-    if len(card_str) != 2:
-        raise ValueError(f"קלט לא תקין עבור הקלף: {card_str}")
-    
-    # פיצול לרמה וסוג
-    rank, suit = card_str[0], card_str[1].lower()  # סוג הקלף באות קטנה כדי להתאים למיפוי
-
-    # המרה לפורמט מתאים
-    return Card.new(f"{rank}{suit}")
+# the bot's event loop (set in post_init), for database queries from the summary server thread
+bot_loop = None
 
 def get_summary():
     """ פונקציה שמחזירה את מספר המשחקים, הצ'אטים והשחקנים """
-    total_games = games_collection.count_documents({})
-    total_chats = len(games_collection.distinct("chat_id"))
-    total_players = players_collection.count_documents({})
+    counts = {"total_games": None, "total_chats": None, "total_players": None}
+    if bot_loop is not None:
+        try:
+            counts = asyncio.run_coroutine_threadsafe(repository.counts(), bot_loop).result(DB_TIMEOUT_MS / 1000 * 3)
+        except Exception as e:
+            print(f"Summary counts failed: {e}")
     return {
-        "total_games": total_games,
-        "total_chats": total_chats,
-        "total_players": total_players
+        **counts,
+        "database": repository.stats(),
+        "equity_cache": equity_cache.stats(),
+        "card_detector": card_detector.stats(),
+        "detection_cache": detection_cache.stats() if detection_cache is not None else None,
+        "sessions": sessions.stats(),
+        "query_audit": query_audit,
+        "startup": startup_times
     }
     
-def initialize_game_start_date_if_needed(game_id):
+def initialize_game_start_date_if_needed(session):
     """ מעדכנת את תאריך ההתחלה של המשחק אם לא הוגדר """
-    active_game = games_collection.find_one({"_id": game_id})
-    if active_game and active_game["start_date"] is None:
-        games_collection.update_one(
-            {"_id": game_id},
-            {"$set": {"start_date": datetime.now()}}
-        )
-        
-def get_or_create_active_game(chat_id):
-    """ מחזירה את game_id של המשחק הפעיל בצ'אט או יוצרת חדש אם אין כזה """
-    active_game = games_collection.find_one({"chat_id": chat_id, "status": "active"})
-    if not active_game:
-        game_id = games_collection.insert_one({
-            "chat_id": chat_id,
-            "start_date": None,
-            "end_date": None,
-            "status": "active",
-            "total_chips_end": 0  # שדה חדש עבור סך הצ'יפים הסופיים
-        }).inserted_id
-    else:
-        game_id = active_game["_id"]
-    return game_id
+    if session.game.get("start_date") is None:
+        session.set_game(start_date=datetime.now())
 
-def end_current_game(chat_id):
+async def end_current_game(chat_id):
     """ מסמנת את המשחק הפעיל כלא פעיל ומעדכנת תאריך סיום """
-    games_collection.update_one(
-        {"chat_id": chat_id, "status": "active"},
-        {"$set": {"status": "inactive", "end_date": datetime.now()}}
-    )
-
-def get_player_data(chat_id, game_id, name):
-    """ מחזירה נתוני שחקן במשחק הנוכחי אם קיים """
-    return players_collection.find_one({"chat_id": chat_id, "game_id": game_id, "name": name.lower()})
+    # stats_pending: the game is added to the player statistics, now or by a later retry
+    game = await sessions.end_game(chat_id, stats_pending=True)
+    if game:
+        try:
+            await repository.apply_pending_stats(chat_id)
+        except Exception as e:
+            # the game stays pending, the next game end or /stats in the chat retries it
+            print(f"Player stats update failed for chat {chat_id}: {e}")
 
 async def send_message(update, message):
-    """ שולחת הודעה לצ'אט הנוכחי """
-    await update.message.reply_text(message)  
+    """ שולחת הודעה לצ'אט הנוכחי ומחזירה אותה """
+    return await update.message.reply_text(message)
 
 async def display_summary(update: Update, ratio: float):
     """מחשב ומציג סיכום המשחק בהתאם ליחס ההמרה שניתן"""
-    chat_id = update.effective_chat.id
-    game_id = get_or_create_active_game(chat_id)
+    session = await sessions.get(update.effective_chat.id)
 
     message = f'סיכום המשחק:\nיחס המרה ₪{ratio}/1000\n'
     players_data = []
 
     # חישוב רווחים והפסדים עבור כל שחקן
-    for player in players_collection.find({"chat_id": chat_id, "game_id": game_id}):
+    for player in session.players.values():
         name = player['name']
         chips_bought, chips_end = player.get('chips_bought'), player.get('chips_end')
         
@@ -219,10 +229,7 @@ async def display_summary(update: Update, ratio: float):
     
     # שמירת דירוג המשחק במסד הנתונים
     sorted_players_data = sorted(players_data, key=lambda x: x['amount'], reverse=True)
-    games_collection.update_one(
-        {"_id": game_id},
-        {"$set": {"ranking": sorted_players_data}}
-    )
+    session.set_game(ranking=[dict(player_data) for player_data in sorted_players_data])
     
     # חישוב העברות כספיות
     transfer_message = "\nהעברות כספיות:\n"
@@ -252,52 +259,139 @@ async def display_summary(update: Update, ratio: float):
 
 async def endgame(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    game_id = games_collection.find_one({"chat_id": chat_id, "status": "active"})
     
-    if not game_id:
+    if await sessions.get(chat_id, create=False) is None:
         await update.message.reply_text("אין משחק פעיל לסיים.")
         return
     
     # סיום המשחק הפעיל
-    end_current_game(chat_id)
+    await end_current_game(chat_id)
     await update.message.reply_text("המשחק הנוכחי הסתיים ונשמר בהיסטוריה.")
 
-def get_total_bought(game_id):
+# The game document keeps running totals of its players - total_bought, total_chips_end and
+# unfinished_players (without end chips) - changed by $inc together with every buy-in and end.
+def get_total_bought(session):
     """מחזירה את סך הצ'יפים שנקנו במשחק."""
-    total_bought_cursor = players_collection.aggregate([
-        {"$match": {"game_id": game_id}},
-        {"$group": {"_id": None, "total_bought": {"$sum": "$chips_bought"}}}
-    ])
-    total_bought_result = list(total_bought_cursor)
-    return total_bought_result[0]["total_bought"] if total_bought_result else 0
-
-def get_unfinished_players(game_id):
+    return session.game.get("total_bought", 0)
+
+def get_unfinished_players(session):
     """מחזירה את רשימת השחקנים שלא סיימו את המשחק (ללא ערך צ'יפים סופי)."""
-    return list(players_collection.find({"game_id": game_id, "chips_end": None}))
-
-def update_total_chips_end(game_id):
-    """מחשב מחדש ומעדכן את סך הצ'יפים הסופיים במשחק."""
-    total_end_cursor = players_collection.aggregate([
-        {"$match": {"game_id": game_id, "chips_end": {"$ne": None}}},
-        {"$group": {"_id": None, "total_end": {"$sum": "$chips_end"}}}
-    ])
-    total_end_result = list(total_end_cursor)
-    total_end = total_end_result[0]["total_end"] if total_end_result else 0
-
-    # עדכון הערך המחושב במסד הנתונים
-    games_collection.update_one(
-        {"_id": game_id},
-        {"$set": {"total_chips_end": total_end}}
-    )
+    return [player for player in session.players.values() if player.get("chips_end") is None]
+
+def buy_chips(session, name, chips):
+    """מוסיפה צ'יפים לשחקן, ויוצרת אותו אם אינו קיים, ומחזירה (השחקן, האם נוסף)."""
+    player = session.get_player(name)
+    added = player is None
+    if added:
+        player = session.add_player(name, chips_end=None)
+        session.increment_game(unfinished_players=1)
+    session.increment_player(player, chips_bought=chips)
+    session.increment_game(total_bought=chips)
+    return player, added
+
+def set_chips_end(session, player, chips_end):
+    """מעדכנת את הצ'יפים הסופיים של שחקן, ואת סכומי המשחק לפי ההפרש."""
+    previous = player.get("chips_end")
+    session.set_player(player, chips_end=chips_end)
+    session.increment_game(total_chips_end=chips_end - (previous or 0),
+                           unfinished_players=-1 if previous is None else 0)
 
 # ==========================
 # probability calculations
 # ==========================
 
-# מטמון בזיכרון
-win_probability_cache = {}
-def create_probability_message(hole_cards, community_cards, hand_stats, multi_win_probability, single_win_probability):
+# מצב היד הנוכחית של כל משחק נשמר בסשן שלו (session.hand_state) בין הרחובות, ונעלם יחד איתו
+def advance_hand_state(session, hole_cards, community_cards):
+    """
+    מקדמת את מצב היד של המשחק לקלפים החדשים, או פותחת מצב חדש אם הקלפים אינם המשך של היד.
+    Raises ValueError for a card that is already known, before anything is stored.
+    """
+    hand_state = session.hand_state
+    if hand_state is None or not hand_state.can_advance(hole_cards, community_cards):
+        hand_state = HandState(hole_cards)
+    hand_state.advance(community_cards)
+    session.hand_state = hand_state
+    return hand_state
+
+def get_game_cards(session):
+    """
+    מחזירה (קלפי השחקן, פלופ, טרן, ריבר) של המשחק: ממצב היד בזיכרון,
+    או מנתוני המשחק אם אין מצב (למשל אחרי הפעלה מחדש של הבוט).
+    """
+    hand_state = session.hand_state
+    if hand_state is not None:
+        board = hand_state.community_cards
+        return (hand_state.hole_cards, board[:3],
+                board[3] if len(board) > 3 else None, board[4] if len(board) > 4 else None)
+
+    game_data = session.game
+    return game_data.get("hole_cards"), game_data.get("flop") or [], game_data.get("turn"), game_data.get("river")
+
+# מטמון תוצאות החישוב, משותף לכל הצ'אטים (מצבים זהים עד כדי החלפת צורות)
+equity_cache = EquityCache(
+    max_entries=EQUITY_CACHE_ENTRIES,
+    max_bytes=EQUITY_CACHE_MB * 1024 * 1024,
+    ttl=EQUITY_CACHE_TTL,
+)
+
+# equity workers (created in main) and the computation in flight for each game
+equity_executor = None
+pending_equity = {}
+
+def start_equity_workers():
+    """
+    Starts the process pool for equity calculations and warms every worker up.
+    Workers are forked before the bot starts any threads and only ever run code from equity.py.
+    """
+    global equity_executor
+    if EQUITY_WORKERS < 1:
+        return
+    equity_executor = ProcessPoolExecutor(
+        max_workers=EQUITY_WORKERS,
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=warm_up,
+    )
+    for future in [equity_executor.submit(warm_up) for _ in range(EQUITY_WORKERS)]:
+        future.result()
+    print(f"Started {EQUITY_WORKERS} equity workers")
+
+async def compute_equity(game_id, hand_state, opponent_count, **options):
+    """
+    Runs calculate_hand_equity (with `options`) in the equity workers, off the event loop.
+    A newer request for the same game cancels the previous one, in which case None is returned.
+    Raises asyncio.TimeoutError when the calculation takes longer than EQUITY_TIMEOUT.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(
+        equity_executor, partial(calculate_hand_equity, hand_state, opponent_count, **options))
+
+    previous = pending_equity.get(game_id)
+    if previous is not None:
+        previous.cancel()
+    pending_equity[game_id] = future
+
+    try:
+        return await asyncio.wait_for(future, EQUITY_TIMEOUT)
+    except asyncio.CancelledError:
+        if pending_equity.get(game_id) is not future:
+            return None  # superseded by a newer street of the same game
+        raise
+    finally:
+        if pending_equity.get(game_id) is future:
+            del pending_equity[game_id]
+
+def format_win_probability(win_probability, tie_probability, stderr):
+    """מעצבת סיכוי לניצחון עם רווח סמך של 95%, ותיקו אם ידוע"""
+    text = f"✅ סיכוי לניצחון: {win_probability:.2f}%"
+    if stderr:
+        text += f" (±{1.96 * stderr:.2f}%)"
+    if tie_probability is not None:
+        text += f" | 🤝 תיקו: {tie_probability:.2f}%"
+    return text
+
+def create_probability_message(hole_cards, community_cards, result, ranges=None):
     """Generate a formatted message with game statistics and probabilities."""
+    hand_stats = result["hand_stats"]
     
     # הצגת קלפי השחקן וקלפי הקהילה בפורמט פשוט
     hole_cards_display = f"{Card.int_to_pretty_str(hole_cards[0])} {Card.int_to_pretty_str(hole_cards[1])}"
@@ -308,6 +402,8 @@ def create_probability_message(hole_cards, community_cards, hand_stats, multi_wi
         f"קלפי השחקן: {hole_cards_display}\n"
         f"קלפי הקהילה: {community_cards_display}\n"
     )
+    if ranges:
+        message += "טווחי יריבים: " + ", ".join(text or "random" for text in ranges) + "\n"
     
     # טבלת סיכויי ידיים עבור כל היריבים
     message += f"\n{'Hand':<15} | {'Player':<10}\n"
@@ -317,107 +413,74 @@ def create_probability_message(hole_cards, community_cards, hand_stats, multi_wi
             player_display = f"{player_percent:>6.2f}%"
             message += f"{hand_type:<15} | {player_display}\n"
             
-    if multi_win_probability is not None:
+    if result["multi_win_probability"] is not None:
         # סיכוי לניצחון, תיקו והפסד עבור כלל היריבים
-        message += f"מול כולם - ✅ סיכוי לניצחון: {multi_win_probability:.2f}%\n"
+        message += "מול כולם - " + format_win_probability(
+            result["multi_win_probability"], result["multi_tie_probability"], result["multi_win_stderr"]) + "\n"
 
     # סיכוי לניצחון, תיקו והפסד עבור יריב אחד בלבד
-    message += f"ראש בראש - ✅ סיכוי לניצחון: {single_win_probability:.2f}%\n\n"
+    message += "ראש בראש - " + format_win_probability(
+        result["single_win_probability"], result["single_tie_probability"], result["single_win_stderr"]) + "\n\n"
 
     return message
 
-async def calculate_probability_and_advice(update, hole_cards, community_cards):
+async def calculate_probability_and_advice(update, session, hand_state):
     """Calculate win probability with detailed breakdown based on hand types."""
-    game_id = get_or_create_active_game(update.effective_chat.id)
+    hole_cards, community_cards = hand_state.hole_cards, hand_state.community_cards
+    game_id = session.game_id
 
     evaluator = Evaluator()
-    opponent_count = players_collection.count_documents(
-        {"chat_id": update.effective_chat.id, "game_id": game_id}
-    ) - 1
+    players = list(session.players.values())
+    opponent_count = len(players) - 1
 
     if opponent_count < 1:
         await send_message(update, "יש לפחות יריב אחד לחישוב הסיכויים.")
         return
+    ranges = get_opponent_ranges(session.game, players, opponent_count)
 
-    num_simulations = 2000
-    hand_counts = {
-        "Royal Flush": 0,
-        "Straight Flush": 0,
-        "Four of a Kind": 0,
-        "Full House": 0,
-        "Flush": 0,
-        "Straight": 0,
-        "Three of a Kind": 0,
-        "Two Pair": 0,
-        "Pair": 0,
-        "High Card": 0
-    }
-    
-    # בדיקה אם יש יותר מיריב אחד
-    if opponent_count > 1:
-        opponent_hand_counts = hand_counts.copy()
-        multi_player_wins = 0
-
-    single_opponent_hand_counts = hand_counts.copy()
-    single_opponent_wins = 0
-
-    for _ in range(num_simulations):
+    # exact enumeration on the turn and river, Monte Carlo sampling otherwise
+    cache_key = equity_cache_key(hole_cards, community_cards, opponent_count, ranges)
+    result = equity_cache.get(cache_key)
+    progress_message = None
+    if result is None:
         try:
-            # הגדרת חבילת קלפים עבור סימולציה מול כל היריבים
-            deck = Deck()
-            deck.cards = [card for card in deck.cards if card not in hole_cards + community_cards]
-
-            # שליפת קלפים לקהילה
-            community_draw = deck.draw(5 - len(community_cards))
-            full_community_cards = community_cards + community_draw
-
-            # חישוב יד השחקן
-            player_score = evaluator.evaluate(hole_cards, full_community_cards)
-            player_hand_type = evaluator.get_rank_class(player_score)
-            hand_counts[evaluator.class_to_string(player_hand_type)] += 1
-            
-            # חישוב מול כל היריבים אם יש יותר מיריב אחד
-            if opponent_count > 1:
-                opponent_hands = [deck.draw(2) for _ in range(opponent_count)]
-                opponent_best_score = min(evaluator.evaluate(hand, full_community_cards) for hand in opponent_hands)
-                opponent_best_hand_type = evaluator.get_rank_class(opponent_best_score)
-                opponent_hand_counts[evaluator.class_to_string(opponent_best_hand_type)] += 1
-
-                if player_score < opponent_best_score:
-                    multi_player_wins += 1
-
-            # סימולציה נפרדת מול יריב אחד בלבד
-            single_opponent_deck = Deck()
-            single_opponent_deck.cards = [card for card in single_opponent_deck.cards if card not in hole_cards + community_cards]
-            single_opponent_hand = single_opponent_deck.draw(2)
-            single_opponent_score = evaluator.evaluate(single_opponent_hand, full_community_cards)
-            single_opponent_hand_type = evaluator.get_rank_class(single_opponent_score)
-            single_opponent_hand_counts[evaluator.class_to_string(single_opponent_hand_type)] += 1
-
-            if player_score < single_opponent_score:
-                single_opponent_wins += 1
-        except Exception as e:
-            print(f"Error in simulation iteration: {e}")
-
-    # חישוב אחוזים לכל יד
-    hand_stats = {}
-    for hand_type in hand_counts:
-        player_percent = (hand_counts[hand_type] / num_simulations) * 100
-        opponent_percent = (opponent_hand_counts[hand_type] / num_simulations) * 100 if opponent_count > 1 else 0
-        single_opponent_percent = (single_opponent_hand_counts[hand_type] / num_simulations) * 100
-
-        # סינון תוצאות קרובות ל-0% בשלב ההדפסה
-        if player_percent > 0.01 or opponent_percent > 0.01 or single_opponent_percent > 0.01:
-            hand_stats[hand_type] = (player_percent, opponent_percent, single_opponent_percent)
+            if EQUITY_PROGRESSIVE:
+                # הערכה מהירה ראשונה, שתעודכן כשהחישוב המלא יסתיים
+                result = await compute_equity(game_id, hand_state, opponent_count,
+                                              num_simulations=EQUITY_QUICK_SIMULATIONS, ranges=ranges)
+                if result is None:
+                    return
+                if needs_refinement(result):
+                    estimate = create_probability_message(hole_cards, community_cards, result, ranges)
+                    progress_message = await send_message(update, estimate + "⏳ מחדד את ההערכה...")
+                    result = None
+
+            if result is None:
+                result = await compute_equity(game_id, hand_state, opponent_count,
+                                              num_simulations=NUM_SIMULATIONS,
+                                              target_stderr=EQUITY_TARGET_STDERR, time_budget=EQUITY_TIME_BUDGET,
+                                              ranges=ranges)
+        except asyncio.TimeoutError:
+            if progress_message is not None:
+                await progress_message.edit_text(estimate)  # the quick estimate stays, without the progress note
+            await send_message(update, "חישוב הסיכויים לקח יותר מדי זמן, נסה שוב.")
+            return
+        if result is None:
+            if progress_message is not None:
+                await progress_message.delete()  # superseded by a newer street, which gets its own message
+            return
+        equity_cache.put(cache_key, result)
+    hand_stats = result["hand_stats"]
+    single_win_probability = result["single_win_probability"]
+    # against a single opponent the heads-up number is also the number against everyone
+    multi_win_probability = headline_win_probability(result)
 
-    # אחוזי ניצחון ותיקו עבור כל היריבים ועבור יריב אחד
-    multi_win_probability = (multi_player_wins / num_simulations) * 100 if opponent_count > 1 else None
-    single_win_probability = (single_opponent_wins / num_simulations) * 100
+    previous_result = hand_state.previous_result()
+    previous_win_probability = headline_win_probability(previous_result) if previous_result else None
+    hand_state.results[len(community_cards)] = result
 
     # יצירת הודעת טקסט עם הסיכויים
-    message = create_probability_message(
-        hole_cards, community_cards, hand_stats,
-        multi_win_probability, single_win_probability)
+    message = create_probability_message(hole_cards, community_cards, result, ranges)
     
     # generate feedback for the player based on the current hand and probabilities
     if not community_cards:
@@ -425,9 +488,32 @@ async def calculate_probability_and_advice(update, hole_cards, community_cards):
     else:
         player_score = evaluator.evaluate(hole_cards, community_cards)
         player_hand_type = evaluator.class_to_string(evaluator.get_rank_class(player_score))
-    feedback = generate_prev_and_opp_feedback(player_hand_type, hand_stats, multi_win_probability, single_win_probability,community_cards,game_id)
+    feedback = generate_prev_and_opp_feedback(player_hand_type, hand_stats, multi_win_probability, single_win_probability,community_cards,previous_win_probability)
 
-    await send_message(update, message + feedback)
+    if progress_message is not None:
+        await progress_message.edit_text(message + feedback)
+    else:
+        await send_message(update, message + feedback)
+
+def get_opponent_ranges(game, players, opponent_count):
+    """
+    טווחי הידיים של היריבים: קודם הטווחים שהוגדרו לשחקנים מסוימים, ואחריהם טווח המשחק
+    לשאר היריבים. None כשכל היריבים אקראיים.
+    """
+    player_ranges = [player["range"] for player in players if player.get("range")]
+    ranges = (player_ranges + [game.get("opponent_range")] * opponent_count)[:opponent_count]
+    return None if all(is_random_range(text) for text in ranges) else ranges
+
+def headline_win_probability(result):
+    """הסיכוי לניצחון מול כל היריבים (או מול היריב היחיד)"""
+    if result["multi_win_probability"] is not None:
+        return result["multi_win_probability"]
+    return result["single_win_probability"]
+
+def needs_refinement(result):
+    """בודקת אם שגיאת התקן של ההערכה גבוהה מהיעד"""
+    stderrs = [result["single_win_stderr"], result["multi_win_stderr"]]
+    return max(stderr for stderr in stderrs if stderr is not None) > EQUITY_TARGET_STDERR
 
 def community_cards_to_stage(community_cards):
     """ממירה את קלפי הקהילה לשלב המתאים במשחק"""
@@ -502,11 +588,11 @@ def generate_hand_feedback(current_hand, community_cards, win_probability_all, w
 
     return "\n".join(advice)
    
-def generate_prev_and_opp_feedback(current_hand, hand_stats, multi_win_probability, single_win_probability,community_cards,game_id):
+def generate_prev_and_opp_feedback(current_hand, hand_stats, multi_win_probability, single_win_probability,community_cards,previous_win_probability):
     """
     יוצר פידבק לשחקן עם עצות מפורטות בהתאם לידו הנוכחית ולשלבי המשחק.
+    previous_win_probability הוא הסיכוי מהרחוב הקודם של אותה יד (מתוך מצב היד), או None.
     """
-    previous_win_probability = get_previous_win_probability_cache(game_id, multi_win_probability)
     feedback_message = ""
     
     # השוואה לשלב הקודם אם קיים
@@ -536,15 +622,7 @@ def generate_prev_and_opp_feedback(current_hand, hand_stats, multi_win_probabili
         
     return feedback_message
 
-def get_previous_win_probability_cache(game_id, new_probability):
-    global win_probability_cache
-    """מחזירה את הסיכוי הקודם מהמטמון עבור game_id מסוים, או None אם לא קיים."""
-    prev = win_probability_cache.get(game_id)
-    win_probability_cache[game_id] = new_probability
-    return prev
 
-    
-    
 # ======================================
 # BOT utilities for text handler commands 
 # ======================================
@@ -557,16 +635,16 @@ async def handle_hole(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     try:
         card1 = parse_card_input(context.args[0])
         card2 = parse_card_input(context.args[1])
-        game_id = get_or_create_active_game(update.effective_chat.id)
+        if card1 == card2:
+            raise ValueError("אותו קלף הוזן פעמיים")
+        session = await sessions.get(update.effective_chat.id)
+        hand_state = advance_hand_state(session, [card1, card2], [])
 
-        # שמירת קלפי השחקן בבסיס הנתונים
-        games_collection.update_one(
-            {"_id": game_id},
-            {"$set": {"hole_cards": [card1, card2], "flop": [], "turn": None, "river": None}}
-        )
+        # שמירת קלפי השחקן בנתוני המשחק
+        session.set_game(hole_cards=[card1, card2], flop=[], turn=None, river=None)
 
         # חישוב הסיכויים הראשוניים עם 5 קלפי קהילה אקראיים
-        await calculate_probability_and_advice(update, [card1, card2], [])
+        await calculate_probability_and_advice(update, session, hand_state)
 
     except Exception as e:
         await update.message.reply_text(f"שגיאה: {e}")
@@ -578,22 +656,20 @@ async def handle_flop(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         return
 
     try:
-        game_id = get_or_create_active_game(update.effective_chat.id)
-        hole_cards = games_collection.find_one({"_id": game_id}).get("hole_cards")
+        session = await sessions.get(update.effective_chat.id)
+        hole_cards, _, _, _ = get_game_cards(session)
 
         if not hole_cards:
             await update.message.reply_text("לא הגדרת עדיין את הקלפים שלך. השתמש ב-/hole.")
             return
 
         flop_cards = [parse_card_input(card) for card in context.args]
+        hand_state = advance_hand_state(session, hole_cards, flop_cards)
 
         # שמירת קלפי הפלופ בלבד
-        games_collection.update_one(
-            {"_id": game_id},
-            {"$set": {"flop": flop_cards}}
-        )
+        session.set_game(flop=flop_cards)
 
-        await calculate_probability_and_advice(update, hole_cards, flop_cards)
+        await calculate_probability_and_advice(update, session, hand_state)
 
     except Exception as e:
         await update.message.reply_text(f"שגיאה: {e}")
@@ -605,24 +681,20 @@ async def handle_turn(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         return
 
     try:
-        game_id = get_or_create_active_game(update.effective_chat.id)
-        game_data = games_collection.find_one({"_id": game_id})
-        hole_cards = game_data.get("hole_cards")
-        flop_cards = game_data.get("flop", [])
+        session = await sessions.get(update.effective_chat.id)
+        hole_cards, flop_cards, _, _ = get_game_cards(session)
 
         if not hole_cards or len(flop_cards) < 3:
             await update.message.reply_text("חסר מידע. השתמש ב-/hole ו-/flop לפני השימוש ב-/turn.")
             return
 
         turn_card = parse_card_input(context.args[0])
+        hand_state = advance_hand_state(session, hole_cards, flop_cards + [turn_card])
 
         # שמירת קלף הטרן בלבד
-        games_collection.update_one(
-            {"_id": game_id},
-            {"$set": {"turn": turn_card}}
-        )
+        session.set_game(turn=turn_card)
 
-        await calculate_probability_and_advice(update, hole_cards, flop_cards + [turn_card])
+        await calculate_probability_and_advice(update, session, hand_state)
 
     except Exception as e:
         await update.message.reply_text(f"שגיאה: {e}")
@@ -634,25 +706,20 @@ async def handle_river(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         return
 
     try:
-        game_id = get_or_create_active_game(update.effective_chat.id)
-        game_data = games_collection.find_one({"_id": game_id})
-        hole_cards = game_data.get("hole_cards")
-        flop_cards = game_data.get("flop", [])
-        turn_card = game_data.get("turn")
+        session = await sessions.get(update.effective_chat.id)
+        hole_cards, flop_cards, turn_card, _ = get_game_cards(session)
 
         if not hole_cards or len(flop_cards) < 3 or not turn_card:
             await update.message.reply_text("חסר מידע. השתמש ב-/hole, /flop ו-/turn לפני השימוש ב-/river.")
             return
 
         river_card = parse_card_input(context.args[0])
+        hand_state = advance_hand_state(session, hole_cards, flop_cards + [turn_card, river_card])
 
         # שמירת קלף הריבר בלבד
-        games_collection.update_one(
-            {"_id": game_id},
-            {"$set": {"river": river_card}}
-        )
+        session.set_game(river=river_card)
 
-        await calculate_probability_and_advice(update, hole_cards, flop_cards + [turn_card, river_card])
+        await calculate_probability_and_advice(update, session, hand_state)
 
     except Exception as e:
         await update.message.reply_text(f"שגיאה: {e}")
@@ -661,36 +728,66 @@ async def handle_river(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 # BOT utility and summary commands handler
 # =======================================
 async def clear(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    chat_id = update.effective_chat.id
-    game_id = get_or_create_active_game(chat_id)
+    session = await sessions.get(update.effective_chat.id)
 
     message = 'מחיקת המשחק:\n'
 
     # מחיקת שחקנים בצ'אט הנוכחי בלבד
-    result = players_collection.delete_many({"chat_id": chat_id, "game_id": game_id})
-    games_collection.update_one(
-        {"_id": game_id},
-        {"$set": {"ranking": []}}
-    )
-    games_collection.update_one(
-            {"_id": game_id},
-            {"$set": {"hole_cards": [], "flop": [], "turn": None, "river": None}}
-    )
+    deleted_count = len(session.players)
+    session.clear_players()
+    session.set_game(ranking=[], hole_cards=[], flop=[], turn=None, river=None,
+                     total_bought=0, total_chips_end=0, unfinished_players=0)
+    session.hand_state = None
     
-    message += f"{result.deleted_count} שחקנים קלפים ודרוג נמחקו\n"
+    message += f"{deleted_count} שחקנים קלפים ודרוג נמחקו\n"
     await update.message.reply_text(message)
 
+async def handle_range(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    מגדירה טווח ידיים ליריבים: /range top 20% לכל היריבים, /range <שם> QQ+,AKs לשחקן מסוים,
+    clear במקום הטווח מבטל אותו, ו-/range לבד מציג את הטווחים הנוכחיים.
+    """
+    session = await sessions.get(update.effective_chat.id)
+    args = context.args or []
+
+    player = session.get_player(args[0]) if len(args) > 1 else None
+    text = " ".join(args[1:] if player else args).strip()
+
+    if not text:
+        message = f"טווח היריבים: {session.game.get('opponent_range') or 'random'}\n"
+        for ranged_player in session.players.values():
+            if "range" in ranged_player:
+                message += f"{ranged_player['name']}: {ranged_player['range']}\n"
+        await update.message.reply_text(message + "שימוש: /range top 20% או /range <שם> QQ+,AKs (clear לביטול)")
+        return
+
+    if text.lower() == "clear":
+        value = UNSET
+    else:
+        try:
+            parse_range(text)
+        except ValueError as e:
+            await update.message.reply_text(f"שגיאה: {e}")
+            return
+        value = text
+
+    if player:
+        session.set_player(player, range=value)
+        await update.message.reply_text(f"הטווח של {player['name']} עודכן: {text}")
+    else:
+        session.set_game(opponent_range=value)
+        await update.message.reply_text(f"טווח היריבים עודכן: {text}")
+
 async def debug(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    chat_id = update.effective_chat.id
-    game_id = get_or_create_active_game(chat_id)
+    session = await sessions.get(update.effective_chat.id)
     message = 'נתוני המשחק:\n'
 
     # הצגת נתוני שחקנים בצ'אט הנוכחי בלבד
-    for player in players_collection.find({"chat_id": chat_id, "game_id": game_id}):
+    for player in session.players.values():
         message += f"שחקן {player['name']} קנה {player['chips_bought']} צ'יפים וסיים עם {player['chips_end']} צ'יפים\n"
     
     # הוספת מידע על מצב המשחק הנוכחי
-    game_data = games_collection.find_one({"_id": game_id})
+    game_data = session.game
     if game_data:
         # קלפי השחקן
         hole_cards = game_data.get("hole_cards", [])
@@ -742,41 +839,9 @@ async def debug(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    players_stats = []
-
-    # שליפת כל המשחקים בצ'אט זה
-    games = games_collection.find({"chat_id": chat_id})
-    player_summary = {}
 
-    # מיפוי רווחים והפסדים עבור כל שחקן בכל המשחקים
-    for game in games:
-        game_ranking = []
-        
-        for player in players_collection.find({"chat_id": chat_id, "game_id": game["_id"]}):
-            name = player['name']
-            chips_bought = player.get('chips_bought', 0)
-            chips_end = player.get('chips_end', 0)
-            profit = chips_end - chips_bought
-            game_ranking.append((name, profit))
-
-            if name not in player_summary:
-                player_summary[name] = {
-                    "total_profit": 0,
-                    "games_played": 0,
-                    "first_place_wins": 0,
-                    "total_rank": 0,
-                }
-            player_summary[name]["total_profit"] += profit
-            player_summary[name]["games_played"] += 1
-        
-        # מיון הדירוג של השחקנים במשחק זה לפי הרווח
-        game_ranking.sort(key=lambda x: x[1], reverse=True)
-
-        # חישוב מיקום לכל שחקן במשחק הנוכחי
-        for rank, (name, profit) in enumerate(game_ranking, start=1):
-            player_summary[name]["total_rank"] += rank
-            if rank == 1:
-                player_summary[name]["first_place_wins"] += 1
+    # הסטטיסטיקות המצטברות של המשחקים שהסתיימו (מתעדכנות בסיום כל משחק)
+    player_summary = {data["name"]: data for data in await repository.get_player_stats(chat_id)}
 
     # בניית הפלט לכל שחקן בנפרד
     message = "סטטיסטיקות כלליות לשחקנים:\n"
@@ -795,36 +860,95 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # שליחת הפלט למשתמש
     await update.message.reply_text(message)
        
+def format_history_game(number, game):
+    """ שורות ההיסטוריה של משחק אחד """
+    start_date = game["start_date"].strftime("%Y-%m-%d %H:%M") if game.get("start_date") else "לא ידוע"
+    end_date = game["end_date"].strftime("%Y-%m-%d %H:%M") if game.get("end_date") else "לא ידוע"
+    message = f"\nמשחק: {number}\nתאריך התחלה: {start_date}\nתאריך סיום: {end_date}\n"
+    # הצגת דירוג אם קיים
+    if 'ranking' in game:
+        message += "דירוג:\n"
+        for player_data in game['ranking']:
+            name = player_data['name']
+            amount = player_data['amount']
+            message += f"{name} {'הרוויח' if amount > 0 else 'הפסיד'} {abs(amount)} ₪\n"
+    else:
+        message += "דירוג לא זמין למשחק זה.\n"
+    return message
+
+def message_chunks(parts, limit=MessageLimit.MAX_TEXT_LENGTH):
+    """ מחברת את החלקים להודעות של עד `limit` תווים; חלק ארוך יותר מפוצל בין השורות """
+    chunk = ""
+    for part in parts:
+        while len(part) > limit:
+            cut = part.rfind("\n", 0, limit) + 1 or limit
+            if chunk:
+                yield chunk
+                chunk = ""
+            yield part[:cut]
+            part = part[cut:]
+        if len(chunk) + len(part) > limit:
+            yield chunk
+            chunk = ""
+        chunk += part
+    if chunk:
+        yield chunk
+
+async def send_history_page(message, chat_id, page, skip=0, before=None, after=None):
+    """
+    שולחת עמוד של היסטוריית המשחקים, בהודעות בגודל מוגבל, עם כפתורי מעבר בין העמודים.
+    Only one page of games (the HISTORY_FIELDS of HISTORY_PAGE_SIZE games) is read at a time.
+    """
+    await sessions.flush_chat(chat_id)  # the active game as it is in memory
+    games, has_older = await repository.history_page(chat_id, HISTORY_PAGE_SIZE, skip=skip, before=before,
+                                                     after=after)
+    if not games:
+        await message.reply_text("אין משחקים בעמוד הזה." if page > 1 else "אין היסטוריית משחקים.")
+        return
+
+    first_number = (page - 1) * HISTORY_PAGE_SIZE + 1
+    parts = [f"היסטוריית משחקים (עמוד {page}):\n"]
+    parts += [format_history_game(number, game) for number, game in enumerate(games, first_number)]
+
+    buttons = []
+    if page > 1:
+        buttons.append(InlineKeyboardButton("→ הקודם", callback_data=f"history:{page - 1}:a:{games[0]['_id']}"))
+    if has_older:
+        buttons.append(InlineKeyboardButton("הבא ←", callback_data=f"history:{page + 1}:b:{games[-1]['_id']}"))
+
+    chunks = list(message_chunks(parts))
+    for index, chunk in enumerate(chunks):
+        last = index == len(chunks) - 1
+        await message.reply_text(chunk, reply_markup=InlineKeyboardMarkup([buttons]) if last and buttons else None)
+
 async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.effective_chat.id
-    games = games_collection.find({"chat_id": chat_id}).sort("start_date", -1)
-    message = "היסטוריית משחקים:\n"
-    count = 1
-    for game in games:
-        start_date = game["start_date"].strftime("%Y-%m-%d %H:%M") if game["start_date"] else "לא ידוע"
-        end_date = game.get("end_date", "לא ידוע").strftime("%Y-%m-%d %H:%M") if game.get("end_date") else "לא ידוע"
-        message += f"\nמשחק: {count}\nתאריך התחלה: {start_date}\nתאריך סיום: {end_date}\n"
-        count += 1
-        # הצגת דירוג אם קיים
-        if 'ranking' in game:
-            message += "דירוג:\n"
-            for player_data in game['ranking']:
-                name = player_data['name']
-                amount = player_data['amount']
-                message += f"{name} {'הרוויח' if amount > 0 else 'הפסיד'} {abs(amount)} ₪\n"
-        else:
-            message += "דירוג לא זמין למשחק זה.\n"
-        
-    await update.message.reply_text(message)
+    """ /history [עמוד] """
+    try:
+        page = int(context.args[0]) if context.args else 1
+        if page < 1:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text("שימוש: /history [מספר עמוד]")
+        return
+    await send_history_page(update.message, update.effective_chat.id, page, skip=(page - 1) * HISTORY_PAGE_SIZE)
+
+async def history_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ כפתורי הבא/הקודם של /history: history:<page>:<b|a>:<game _id> """
+    query = update.callback_query
+    await query.answer()
+    if query.message is None or not query.message.is_accessible:
+        return  # a button on a message that is too old, or that the bot can no longer see
+    _, page, direction, game_id = query.data.split(":")
+    anchor = {"before": ObjectId(game_id)} if direction == "b" else {"after": ObjectId(game_id)}
+    await send_history_page(query.message, update.effective_chat.id, int(page), **anchor)
  
 # =============================
 # Bot but end handler utilities
 # =============================
 async def handle_buy(update: Update, message_text: str) -> None:
     """פונקציה לטיפול בקניית צ'יפים עם פורמט '+<כמות> <שמות>'"""
-    chat_id = update.effective_chat.id
-    game_id = get_or_create_active_game(chat_id)
-    initialize_game_start_date_if_needed(game_id)
+    session = await sessions.get(update.effective_chat.id)
+    initialize_game_start_date_if_needed(session)
 
     try:
         # מסירים את התו `+` ומחלקים
@@ -836,25 +960,14 @@ async def handle_buy(update: Update, message_text: str) -> None:
             await send_message(update, "שימוש: +<כמות צ'יפים> <שם1> <שם2> ...")
             return
 
+        # all the buy-ins are written together, as $inc upserts of the players (see sessions.py)
         messages = []
         for name in names:
-            player = get_player_data(chat_id, game_id, name)
-            if player:
-                chips_total = chips_bought + player['chips_bought']
-                players_collection.update_one(
-                    {"_id": player["_id"]},
-                    {"$set": {"chips_bought": chips_total}}
-                )
-                messages.append(f"שחקן {name} קיים, נוספו לו {chips_bought} צ'יפים (סה\"כ {chips_total})")
-            else:
-                players_collection.insert_one({
-                    "chat_id": chat_id,
-                    "game_id": game_id,
-                    "name": name.lower(),
-                    "chips_bought": chips_bought,
-                    "chips_end": None
-                })
+            player, added = buy_chips(session, name, chips_bought)
+            if added:
                 messages.append(f"שחקן {name} נוסף עם {chips_bought} צ'יפים")
+            else:
+                messages.append(f"שחקן {name} קיים, נוספו לו {chips_bought} צ'יפים (סה\"כ {player['chips_bought']})")
 
         await send_message(update, "\n".join(messages))
     except (IndexError, ValueError):
@@ -862,39 +975,34 @@ async def handle_buy(update: Update, message_text: str) -> None:
 
 async def handle_end(update: Update, message_text: str, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Process end command in the format '<name>=<amount>'."""
-    chat_id = update.effective_chat.id
-    game_id = get_or_create_active_game(chat_id)
+    session = await sessions.get(update.effective_chat.id)
 
     try:
         # Parse message text for end command format
         name, chips_end = message_text.split('=')
         name, chips_end = name.strip(), int(chips_end.strip())
         
-        player = get_player_data(chat_id, game_id, name)
+        player = session.get_player(name)
 
         if player:
-            players_collection.update_one({"_id": player["_id"]}, {"$set": {"chips_end": chips_end}})
-            update_total_chips_end(game_id)            
+            set_chips_end(session, player, chips_end)
             await send_message(update, f"שחקן {name} סיים עם {chips_end} צ'יפים")
         else:
             await send_message(update, f"שחקן {name} לא קיים")
             return
         
         # בדיקה אם נשאר רק שחקן אחד ללא ערך צ'יפים סופי
-        unfinished_players = get_unfinished_players(game_id)
-        if len(unfinished_players) == 1:
-            remaining_player = unfinished_players[0]
+        # the counter on the game, no pass over the players unless exactly one is left
+        if session.game.get("unfinished_players") == 1:
+            remaining_player = get_unfinished_players(session)[0]
 
             # חישוב הצ'יפים הנותרים עבור השחקן האחרון
-            total_bought = get_total_bought(game_id)
-            total_end = games_collection.find_one({"_id": game_id}).get("total_chips_end", 0)
+            total_bought = get_total_bought(session)
+            total_end = session.game.get("total_chips_end", 0)
             remaining_chips = total_bought - total_end
 
             # עדכון השחקן האחרון עם סכום הצ'יפים הנותרים
-            players_collection.update_one(
-                {"_id": remaining_player["_id"]},
-                {"$set": {"chips_end": remaining_chips}}
-            )
+            set_chips_end(session, remaining_player, remaining_chips)
             await send_message(update, f"שחקן {remaining_player['name']} הושלם אוטומטית עם {remaining_chips} צ'יפים.")
             
             # כל השחקנים סיימו והסכום תואם - בקשה ליחס המרה
@@ -910,21 +1018,32 @@ async def handle_end(update: Update, message_text: str, context: ContextTypes.DE
 # Message Handler Main
 # ==========================
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    # קבלת מזהה המשחק הפעיל
-    game_id = get_or_create_active_game(update.effective_chat.id)
-    game_data = games_collection.find_one({"_id": game_id})
+    # קבלת המשחק הפעיל
+    session = await sessions.get(update.effective_chat.id)
     
     # בדיקה אם ההודעה מכילה תמונה
     if update.message.photo:
-        # הורדת התמונה
-        photo_file = await update.message.photo[-1].get_file()
-        tempfilename = f"{tempfile.gettempdir()}/{photo_file.file_id}.jpg"
-        await photo_file.download_to_drive(tempfilename)
-
-        # זיהוי הקלפים בתמונה
-        detected_cards = get_distinct_identified_cards(card_model, tempfilename)
+        photo_size = pick_photo_size(update.message.photo)
+        # תמונה שכבר זוהתה (נשלחה שוב או הועברה) - בלי הורדה ובלי זיהוי
+        # (in a thread: a miss in memory may read the persisted cache from MongoDB)
+        cached_cards = (await asyncio.to_thread(detection_cache.get, photo_size.file_unique_id)
+                        if detection_cache is not None else None)
+        if cached_cards is not None:
+            detected_cards = [label for label, _ in cached_cards]
+        else:
+            # הורדת התמונה לזיכרון (היא מפוענחת פעם אחת, בתהליכון הזיהוי)
+            photo_file = await photo_size.get_file()
+            photo = await photo_file.download_as_bytearray()
+            if not card_detector.ready.is_set():
+                await send_message(update, "⏳ מודל זיהוי הקלפים עדיין נטען, התמונה תזוהה מיד כשיהיה מוכן.")
+
+            # זיהוי הקלפים בתמונה (בתהליכון הזיהוי, בלי לחסום את הבוט)
+            try:
+                detected_cards = await card_detector.detect(photo, photo_size.file_unique_id, update.effective_chat.id)
+            except (DetectorBusy, ValueError, RuntimeError) as e:  # RuntimeError: the model failed to load
+                await send_message(update, str(e))
+                return
         await send_message(update,f"קלפים שזוהו: {detected_cards}")
-        os.remove(tempfilename)
 
         try:
             # טיפול בהתאם לכמות הקלפים שנמצאו
@@ -938,14 +1057,13 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 await handle_flop(update, context)
             elif len(detected_cards) == 4:
                 # get flop cards to identify the forth card
-                flop_cards = game_data.get("flop", [])
+                _, flop_cards, _, _ = get_game_cards(session)
                 turn_card = [card for card in detected_cards if parse_card_input(card) not in flop_cards]
                 context.args = turn_card
                 await handle_turn(update, context)
             elif len(detected_cards) == 5 :
                 # get flop cards and turn to identify the forth card
-                flop_cards = game_data.get("flop", [])
-                turn_card = game_data.get("turn")
+                _, flop_cards, turn_card, _ = get_game_cards(session)
                 river_card = [card for card in detected_cards if parse_card_input(card) not in flop_cards and parse_card_input(card) != turn_card]
                 context.args = river_card
                 await handle_river(update, context)
@@ -988,11 +1106,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             context.args = detected_cards
             await handle_flop(update, context)
         elif len(detected_cards) == 1:
-            flop_cards = game_data.get("flop", [])
+            _, flop_cards, turn_card, _ = get_game_cards(session)
             if not flop_cards:
                 await send_message(update,"אין קלפי פלופ עדיין. השתמש ב-3 קלפים לפלופ אח״ג תוסיף קלף לטרן וקלף לריבר.")
                 return
-            turn_card = game_data.get("turn")
             if turn_card is None:
                 context.args = detected_cards
                 await handle_turn(update, context)
@@ -1004,16 +1121,69 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
             
 # הוספת הגדרות ל-main
+# seconds from process start until each part was ready
+startup_times = {}
+
+database_warm_up = None
+
+async def warm_up_database():
+    """ מתחברת למסד ברקע ובודקת שהוא זמין, כדי שהפקודה הראשונה לא תחכה לחיבור """
+    try:
+        await repository.ping()
+        startup_times["database_ready_s"] = time.monotonic() - PROCESS_STARTED
+        await repository.ensure_indexes()
+        if DB_QUERY_AUDIT:
+            query_audit[:] = await repository.audit_queries(DB_SLOW_QUERY_MS, HISTORY_PAGE_SIZE)
+        if detection_cache is not None and DETECTION_CACHE_PERSIST:
+            loaded = await asyncio.to_thread(detection_cache.load)
+            print(f"Detection cache: loaded {loaded} photos from MongoDB")
+    except Exception as e:
+        print(f"MongoDB warm-up failed: {e}")
+
+def report_model_ready():
+    card_detector.ready.wait()
+    startup_times["card_model_ready_s"] = time.monotonic() - PROCESS_STARTED
+    print(f"Cold start: card model ready {startup_times['card_model_ready_s']:.2f}s after process start")
+
+async def report_polling(application):
+    startup_times["polling_s"] = time.monotonic() - PROCESS_STARTED
+    print(f"Cold start: polling {startup_times['polling_s']:.2f}s after process start "
+          f"(equity workers ready after {startup_times['equity_workers_ready_s']:.2f}s)")
+
+async def post_init(application):
+    global bot_loop, database_warm_up
+    bot_loop = asyncio.get_running_loop()
+    # the database is connected in the background while the bot already answers
+    database_warm_up = bot_loop.create_task(warm_up_database())
+    sessions.start()
+    await report_polling(application)
+
+async def post_shutdown(application):
+    # game changes that were not written yet
+    await sessions.close()
+    await repository.close()
+
 def main():
+    # Fork the equity workers before any other thread is started
+    start_equity_workers()
+    startup_times["equity_workers_ready_s"] = time.monotonic() - PROCESS_STARTED
+
+    # model and database are loaded in the background while the bot already answers text commands
+    card_detector.start()
+    threading.Thread(target=report_model_ready, daemon=True).start()
+
     # Run the dummy server in a separate thread
     print("Starting dummy server thread")
     threading.Thread(target=start_summary_server, daemon=True).start()
     
-    application = Application.builder().token(TOKEN).build()
+    # concurrent updates so a long calculation in one chat does not hold the others
+    application = Application.builder().token(TOKEN).concurrent_updates(True).post_init(post_init).post_shutdown(post_shutdown).build()
     handlers = [
         CommandHandler("clear", clear),
+        CommandHandler("range", handle_range),
         CommandHandler("debug", debug),
         CommandHandler("history", history),
+        CallbackQueryHandler(history_button, pattern=r"^history:"),
         CommandHandler("stats", stats),
         MessageHandler(filters.PHOTO | filters.TEXT, handle_message)
     ]
@@ -1030,6 +1200,10 @@ def main():
     
     print("Bot polling")
     application.run_polling(poll_interval=2.0, timeout=10)
+
+    card_detector.stop()
+    if equity_executor is not None:
+        equity_executor.shutdown(cancel_futures=True)
     
 if __name__ == '__main__':
     main()
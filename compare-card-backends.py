@@ -0,0 +1,82 @@
+"""
+Side-by-side accuracy and latency of card detector backends on the same photos:
+
+    python compare-card-backends.py --models yolov8s_playing_cards-1.pt \\
+        yolov8s_playing_cards-1.onnx yolov8s_playing_cards-1-int8.onnx
+
+The first model is the reference. For every other model it reports whether the class
+names match, on how many photos the detected cards (identify_cards) and
+the raw labels are the same, the largest confidence difference on matching labels, and
+the p50/mean latency of one model call per photo.
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+from detector import identify_cards, load_card_model
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+def detections(result):
+    """(label, confidence) of every box, most confident first."""
+    boxes = [(result.names[int(box.cls)], float(box.conf)) for box in result.boxes or []]
+    return sorted(boxes, key=lambda x: x[1], reverse=True)
+
+
+def run_model(path, images, repeats):
+    model = load_card_model(path)
+    model(images[0])  # warm-up
+    outputs, latencies = {}, []
+    for image in images:
+        for _ in range(repeats):
+            start = time.perf_counter()
+            result = model(image)[0]
+            latencies.append(time.perf_counter() - start)
+        outputs[image] = (detections(result), identify_cards(result, image))
+    return {str(key): value for key, value in result.names.items()}, outputs, latencies
+
+
+def compare(reference, candidate):
+    """Counts of equal card lists, equal raw labels, and the largest confidence gap on shared labels."""
+    same_cards = same_labels = 0
+    max_confidence_diff = 0.0
+    for image, (boxes, cards) in reference.items():
+        candidate_boxes, candidate_cards = candidate[image]
+        same_cards += cards == candidate_cards
+        same_labels += [label for label, _ in boxes] == [label for label, _ in candidate_boxes]
+        best = {}
+        for label, confidence in candidate_boxes:
+            best.setdefault(label, confidence)
+        for label, confidence in boxes:
+            if label in best:
+                max_confidence_diff = max(max_confidence_diff, abs(confidence - best[label]))
+    return same_cards, same_labels, max_confidence_diff
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare card detector backends")
+    parser.add_argument("--models", nargs="+", required=True, help="model files, the first one is the reference")
+    parser.add_argument("--images", default="test-images")
+    parser.add_argument("--repeats", type=int, default=3, help="timed calls per photo")
+    args = parser.parse_args()
+
+    images = sorted(os.path.join(args.images, name) for name in os.listdir(args.images)
+                    if name.lower().endswith(IMAGE_EXTENSIONS) and "processed" not in name)
+    print(f"{len(images)} photos")
+
+    runs = [(path, *run_model(path, images, args.repeats)) for path in args.models]
+    _, reference_names, reference, _ = runs[0]
+
+    print(f"{'model':<40} {'p50 ms':>8} {'mean ms':>8} {'names':>6} {'cards':>7} {'labels':>7} {'max Δconf':>10}")
+    for path, names, outputs, latencies in runs:
+        same_cards, same_labels, max_diff = compare(reference, outputs)
+        print(f"{os.path.basename(path):<40} {np.percentile(latencies, 50) * 1000:>8.1f} "
+              f"{np.mean(latencies) * 1000:>8.1f} {'same' if names == reference_names else 'DIFF':>6} "
+              f"{same_cards:>3}/{len(images):<3} {same_labels:>3}/{len(images):<3} {max_diff:>10.4f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,679 @@
+"""
+Playing-card detection for the bot.
+
+Photos are handled as decoded BGR arrays (see `load_image`): a photo is decoded once
+and the same array is passed to the model and, if enabled, to the contour counter.
+
+The model finds the rank/suit index in the corners of a card, usually both corners.
+`cluster_cards` turns those boxes into physical cards: overlapping boxes of different
+classes are one corner read two ways (cross-class NMS keeps the most confident), boxes
+left with the same label are corners of the same card, as a deck holds every card once,
+and two lone corners at opposite corners of a card are paired by their positions.
+`identify_cards` returns the labels of those cards, most confident first; the old
+OpenCV contour count can still cap it (`use_contours`).
+
+`CardDetectionService` does the same for concurrent photos from a worker
+thread: requests that arrive within a few milliseconds of each other are run as one
+batched model call, so the event loop never waits for a forward pass. With a
+`DetectionCache` it remembers the cards of every photo by its Telegram file_unique_id
+and a perceptual hash, so a photo sent again is neither downloaded nor detected again.
+
+`load_card_model` picks the backend from the model file: a .pt file is run by
+ultralytics (PyTorch), an exported .onnx file by `OnnxCardModel` on ONNX Runtime,
+which returns results in the same shape without importing torch at all.
+"""
+import ast
+import asyncio
+import itertools
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+
+import cv2
+import numpy as np
+
+
+# ==========================
+# Card identification logic
+# ==========================
+def decode_image(data):
+    """מפענחת תמונה מקודדת (JPEG/PNG) מהזיכרון למערך BGR"""
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("לא ניתן לפענח את התמונה")
+    return image
+
+
+def load_image(image):
+    """A decoded BGR array from an array (returned as is), encoded bytes or a file path."""
+    if isinstance(image, np.ndarray):
+        return image
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return decode_image(image)
+    decoded = cv2.imread(image)
+    if decoded is None:
+        raise ValueError(f"לא ניתן לקרוא את התמונה: {image}")
+    return decoded
+
+
+def count_cards(image):
+    """Counts card outlines with OpenCV (the optional cap on the detected cards)."""
+    # Load the image (a path, encoded bytes or an already decoded array)
+    image = load_image(image)
+
+    # Convert to grayscale
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    # Apply Gaussian Blur to reduce noise
+    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+
+    # Apply Canny Edge Detection
+    edges = cv2.Canny(blurred, threshold1=30, threshold2=150)
+
+    # Find contours
+    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    # Filter contours based on area and aspect ratio
+    card_contours = []
+    for contour in contours:
+        area = cv2.contourArea(contour)
+        if area > 1000:  # Filter out small contours
+            # Approximate the contour to reduce the number of points
+            perimeter = cv2.arcLength(contour, True)
+            approx = cv2.approxPolyDP(contour, 0.02 * perimeter, True)
+
+            # Check if the contour has 4 sides (rectangle-like shape)
+            if len(approx) == 4:
+                card_contours.append(contour)
+
+    return len(card_contours)
+
+CROSS_CLASS_IOU = 0.5  # boxes of different classes overlapping more than this are the same corner
+# The two corner indices of a card sit at opposite corners: their centers are about three
+# index heights apart (a 63x88 mm card, a ~25 mm index) along a diagonal of the card.
+CORNER_PAIR_DISTANCE = 3.0  # expected center distance, in index box long sides
+CORNER_PAIR_TOLERANCE = 1.5  # accepted difference from CORNER_PAIR_DISTANCE
+CORNER_PAIR_MIN_SLOPE = 0.35  # both axes of a diagonal are at least this part of its length
+
+
+def card_boxes(result):
+    """labels, confidences and xyxy boxes of one YOLO result (ultralytics or `Detections`)"""
+    boxes = list(result.boxes or [])
+    labels = [result.names[int(box.cls)] for box in boxes]
+    confidences = np.array([float(box.conf) for box in boxes], dtype=np.float64)
+    xyxy = np.array([np.asarray(box.xyxy, dtype=np.float64).reshape(-1)[:4] for box in boxes]).reshape(-1, 4)
+    return labels, confidences, xyxy
+
+
+def corner_pair_error(box_a, box_b):
+    """
+    How far two corner boxes are from the two corners of one card: the difference of their
+    center distance from CORNER_PAIR_DISTANCE (in index sizes), or None when they cannot be
+    the same card (too near, too far, or not along a diagonal).
+    """
+    size = (max(box_a[2] - box_a[0], box_a[3] - box_a[1]) + max(box_b[2] - box_b[0], box_b[3] - box_b[1])) / 2
+    dx = abs((box_a[0] + box_a[2]) - (box_b[0] + box_b[2])) / 2
+    dy = abs((box_a[1] + box_a[3]) - (box_b[1] + box_b[3])) / 2
+    distance = np.hypot(dx, dy)
+    if size <= 0 or min(dx, dy) < CORNER_PAIR_MIN_SLOPE * distance:
+        return None
+    error = abs(distance / size - CORNER_PAIR_DISTANCE)
+    return error if error <= CORNER_PAIR_TOLERANCE else None
+
+
+def cluster_cards(result, iou_threshold=CROSS_CLASS_IOU):
+    """
+    Merges the boxes of one YOLO result into physical cards:
+    - boxes of different classes on one spot are one corner read two ways (cross-class
+      NMS keeps the most confident reading);
+    - boxes with the same label are corners of the same card, as a deck holds every card once;
+    - a lone corner is paired with another lone corner at the opposite corner of a card
+      (`corner_pair_error`, the best fitting pairs first), so a misread second corner
+      (6/9, a wrong suit) does not count as another card.
+    A card takes the label of its most confident box.
+    Returns [(label, confidence, boxes)] per card, most confident first, where
+    confidence is that of the card's best box and boxes are its corners (xyxy).
+    """
+    labels, confidences, xyxy = card_boxes(result)
+    if not labels:
+        return []
+
+    # one corner read as two classes -> keep the most confident reading
+    keep = non_max_suppression(xyxy, confidences, np.zeros(len(labels)), iou_threshold, len(labels))
+
+    clusters = {}  # label of the first box -> kept box indices, most confident first
+    for i in keep.tolist():
+        clusters.setdefault(labels[i], []).append(i)
+
+    single = [boxes[0] for boxes in clusters.values() if len(boxes) == 1]
+    pairs = []
+    for a, b in itertools.combinations(single, 2):
+        error = corner_pair_error(xyxy[a], xyxy[b])
+        if error is not None:
+            pairs.append((error, a, b))
+    paired = set()
+    for _, a, b in sorted(pairs):
+        if a in paired or b in paired:
+            continue
+        paired |= {a, b}
+        best, other = (a, b) if confidences[a] >= confidences[b] else (b, a)
+        print(f"Corners {labels[best]} and {labels[other]} are one card, kept {labels[best]}")
+        clusters[labels[best]].append(other)
+        del clusters[labels[other]]
+
+    cards = []
+    for boxes in clusters.values():
+        best = max(boxes, key=lambda i: confidences[i])
+        cards.append((labels[best], confidences[best], [xyxy[i].tolist() for i in boxes]))
+    cards.sort(key=lambda card: -card[1])
+    for label, confidence, boxes in cards:
+        print(f"Identified card: {label} with confidence: {confidence:.2f} ({len(boxes)} corners)")
+    return cards
+
+
+def card_detections(result, image, use_contours=False):
+    """
+    (label, confidence) of the cards of one photo, most confident first; with `use_contours`
+    capped by `count_cards` (ignored when it finds none).
+    """
+    cards = [(label, round(float(confidence), 4)) for label, confidence, _ in cluster_cards(result)]
+    num_cards = count_cards(image) if use_contours else None
+    return cards[:num_cards] if num_cards else cards
+
+
+def identify_cards(result, image, use_contours=False):
+    """The labels of the cards of one photo, see `card_detections`."""
+    return [label for label, _ in card_detections(result, image, use_contours)]
+
+
+# ==========================
+# Preprocessing
+# ==========================
+MODEL_IMAGE_SIZE = 640  # input size of the card model
+TABLE_PASS_SIZE = 160  # longest side of the low-res pass that looks for the table
+TABLE_MARGIN = 0.05  # kept around the table, as a fraction of its size
+
+
+def resize_image(image, max_side):
+    """מקטינה את התמונה כך שהצלע הארוכה תהיה max_side (לא מגדילה)"""
+    height, width = image.shape[:2]
+    scale = max_side / max(height, width)
+    if scale >= 1:
+        return image
+    return cv2.resize(image, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+
+
+def table_region(image):
+    """
+    Bounding box (x0, y0, x1, y1) of the felt in the photo, found on a small copy by its
+    saturated green/blue color, or None when no plausible table is found.
+    """
+    small = resize_image(image, TABLE_PASS_SIZE)
+    hsv = cv2.cvtColor(small, cv2.COLOR_BGR2HSV)
+    felt = cv2.inRange(hsv, (35, 60, 30), (130, 255, 255))
+    felt = cv2.morphologyEx(felt, cv2.MORPH_CLOSE, np.ones((5, 5), np.uint8))
+    contours, _ = cv2.findContours(felt, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return None
+    x, y, w, h = cv2.boundingRect(max(contours, key=cv2.contourArea))
+    coverage = w * h / (small.shape[0] * small.shape[1])
+    if not 0.1 <= coverage <= 0.9:  # nothing that looks like a table, or the table is the whole photo
+        return None
+
+    scale = image.shape[1] / small.shape[1]
+    margin_x, margin_y = w * TABLE_MARGIN, h * TABLE_MARGIN
+    return (max(0, int((x - margin_x) * scale)), max(0, int((y - margin_y) * scale)),
+            min(image.shape[1], int((x + w + margin_x) * scale)), min(image.shape[0], int((y + h + margin_y) * scale)))
+
+
+def preprocess_image(image, image_size=MODEL_IMAGE_SIZE, crop_table=False):
+    """
+    The image the model sees: optionally cropped to the table (a view, no copy), then
+    scaled down so its longest side is `image_size` (0 keeps the full resolution).
+    """
+    if crop_table:
+        region = table_region(image)
+        if region is not None:
+            x0, y0, x1, y1 = region
+            image = image[y0:y1, x0:x1]
+    return resize_image(image, image_size) if image_size else image
+
+
+# ==========================
+# Result cache
+# ==========================
+HASH_SIZE = 16  # difference hash of a 17x16 grayscale copy: 256 bits
+
+
+def image_hash(image):
+    """
+    Difference hash of a photo. It is too coarse to tell card faces apart (another rank on
+    the same card moves no bits), so it only matches a photo to the same photo sent again.
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (HASH_SIZE + 1, HASH_SIZE), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def similar_photo_key(chat_id, image, photo_hash):
+    """The key of a photo for `DetectionCache.find_similar`: its chat, its size and its hash."""
+    return (chat_id, image.shape[0], image.shape[1], photo_hash)
+
+
+class DetectionCache:
+    """
+    LRU cache of the cards [(label, confidence)] detected on a photo, keyed by its Telegram
+    file_unique_id. With `match_similar` a photo is also matched to a cached photo of the
+    same chat with the same size and the same perceptual hash (`similar_photo_key`), for a
+    photo uploaded again as a new file. Off by default: the hash cannot tell card faces
+    apart, so a near match would give a new hand the cards of the previous one.
+
+    With a Mongo `collection` every entry is also written there: `load` refills memory with
+    the newest entries after a restart, and id lookups that miss memory fall back to it.
+    Used from the event loop (`get`) and the detector thread (`find_similar`, `put`).
+    """
+
+    def __init__(self, max_entries=2000, match_similar=False, collection=None):
+        self.max_entries = max_entries
+        self.match_similar = match_similar
+        self.collection = collection
+        self.hits = 0
+        self.hash_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # file_unique_id -> (cards, similar photo key or None)
+        self._similar = {}  # similar photo key -> file_unique_id
+        self._lock = threading.Lock()
+
+    def get(self, file_id):
+        """הקלפים השמורים של תמונה לפי file_unique_id, או None"""
+        with self._lock:
+            entry = self._entries.get(file_id)
+            if entry is not None:
+                self._entries.move_to_end(file_id)
+                self.hits += 1
+                return entry[0]
+        if self.collection is not None:
+            try:
+                document = self.collection.find_one({"_id": file_id})
+            except Exception as e:
+                print(f"Detection cache lookup failed: {e}")
+                document = None
+            if document is not None:
+                cards, key = _entry_from_document(document)
+                self._store(file_id, cards, key)
+                with self._lock:
+                    self.hits += 1
+                return cards
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def find_similar(self, key):
+        """The cards of the cached photo with the same `similar_photo_key`, or None."""
+        if not self.match_similar:
+            return None
+        with self._lock:
+            file_id = self._similar.get(key)
+            if file_id is None:
+                return None
+            self._entries.move_to_end(file_id)
+            self.hash_hits += 1
+            return self._entries[file_id][0]
+
+    def put(self, file_id, cards, key=None):
+        self._store(file_id, cards, key)
+        if self.collection is not None:
+            document = {"cards": [{"label": label, "confidence": confidence} for label, confidence in cards],
+                        "created_at": time.time()}
+            if key is not None:
+                chat_id, height, width, photo_hash = key
+                document.update(chat_id=chat_id, height=height, width=width, hash=f"{photo_hash:x}")
+            try:
+                self.collection.replace_one({"_id": file_id}, document, upsert=True)
+            except Exception as e:
+                print(f"Detection cache write failed: {e}")
+
+    def load(self):
+        """Fills memory with the newest persisted entries (after a restart)."""
+        if self.collection is None:
+            return 0
+        documents = list(self.collection.find().sort("created_at", -1).limit(self.max_entries))
+        for document in reversed(documents):  # oldest first, so the newest are the most recently used
+            self._store(document["_id"], *_entry_from_document(document))
+        return len(documents)
+
+    def _store(self, file_id, cards, key):
+        with self._lock:
+            self._entries[file_id] = (cards, key)
+            self._entries.move_to_end(file_id)
+            if key is not None:
+                self._similar[key] = file_id
+            while len(self._entries) > self.max_entries:
+                evicted_id, (_, evicted_key) = self._entries.popitem(last=False)
+                if evicted_key is not None and self._similar.get(evicted_key) == evicted_id:
+                    del self._similar[evicted_key]
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "hash_hits": self.hash_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+def _entry_from_document(document):
+    cards = [(card["label"], card["confidence"]) for card in document["cards"]]
+    if "chat_id" not in document or "hash" not in document:
+        return cards, None  # no similar photo key (or one from before it was per chat)
+    return cards, (document["chat_id"], document["height"], document["width"], int(document["hash"], 16))
+
+
+# ==========================
+# Model backends
+# ==========================
+DetectedBox = namedtuple("DetectedBox", "cls conf xyxy")
+Detections = namedtuple("Detections", "names boxes")  # the parts of an ultralytics Results used here
+
+
+def load_card_model(path):
+    """טוענת את מודל הקלפים לפי סוג הקובץ: onnx ב-ONNX Runtime, אחרת ultralytics"""
+    if os.path.splitext(path)[1].lower() == ".onnx":
+        return OnnxCardModel(path)
+    from ultralytics import YOLO
+    return YOLO(path)
+
+
+def letterbox(image, size, color=(114, 114, 114)):
+    """Resizes keeping the aspect ratio and pads to `size` (height, width), as ultralytics does."""
+    height, width = image.shape[:2]
+    gain = min(size[0] / height, size[1] / width)
+    new_width, new_height = int(round(width * gain)), int(round(height * gain))
+    if (new_width, new_height) != (width, height):
+        image = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+    pad_width, pad_height = (size[1] - new_width) / 2, (size[0] - new_height) / 2
+    top, bottom = int(round(pad_height - 0.1)), int(round(pad_height + 0.1))
+    left, right = int(round(pad_width - 0.1)), int(round(pad_width + 0.1))
+    return cv2.copyMakeBorder(image, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color), gain, (left, top)
+
+
+def non_max_suppression(boxes, scores, classes, iou_threshold, max_detections):
+    """Greedy per-class NMS on xyxy boxes, highest score first; returns the kept indices."""
+    order = np.argsort(-scores, kind="stable")
+    shifted = boxes + classes[:, None] * 7680.0  # boxes of different classes never overlap
+    areas = (shifted[:, 2] - shifted[:, 0]) * (shifted[:, 3] - shifted[:, 1])
+    keep = []
+    while order.size and len(keep) < max_detections:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        top_left = np.maximum(shifted[i, :2], shifted[rest, :2])
+        bottom_right = np.minimum(shifted[i, 2:], shifted[rest, 2:])
+        intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=1)
+        iou = intersection / (areas[i] + areas[rest] - intersection + 1e-9)
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype=np.intp)
+
+
+class OnnxCardModel:
+    """
+    YOLOv8 card detector exported to ONNX (see export-card-model.py), run on ONNX Runtime.
+
+    Called like the ultralytics model with one image (path or BGR array) or a list of them, and returns
+    one `Detections` per image with the class names from the model metadata and the boxes
+    left after the same confidence threshold and per-class NMS ultralytics applies.
+    """
+
+    def __init__(self, path, conf=0.25, iou=0.7, max_detections=300, threads=None):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.names = ast.literal_eval(metadata["names"])
+        self.imgsz = tuple(ast.literal_eval(metadata.get("imgsz", "[640, 640]")))
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.dynamic_batch = not isinstance(model_input.shape[0], int)
+        self.conf = conf
+        self.iou = iou
+        self.max_detections = max_detections
+
+    def __call__(self, source):
+        sources = [source] if isinstance(source, (str, np.ndarray)) else list(source)
+        images = [load_image(image) for image in sources]
+        inputs, transforms = [], []
+        for image in images:
+            padded, gain, pad = letterbox(image, self.imgsz)
+            inputs.append(padded[:, :, ::-1].transpose(2, 0, 1))  # BGR HWC -> RGB CHW
+            transforms.append((gain, pad, image.shape[:2]))
+        batch = np.ascontiguousarray(np.stack(inputs), dtype=np.float32) / 255
+
+        if self.dynamic_batch:
+            outputs = self.session.run(None, {self.input_name: batch})[0]
+        else:
+            outputs = np.concatenate([self.session.run(None, {self.input_name: batch[i:i + 1]})[0]
+                                      for i in range(len(batch))])
+        return [self._detections(output, *transform) for output, transform in zip(outputs, transforms)]
+
+    def _detections(self, output, gain, pad, shape):
+        """One image's raw output (4 + classes, anchors) -> Detections in original image coordinates."""
+        output = output.T
+        class_scores = output[:, 4:]
+        classes = class_scores.argmax(axis=1)
+        scores = class_scores[np.arange(len(classes)), classes]
+        candidates = scores > self.conf
+        xywh, classes, scores = output[candidates, :4], classes[candidates], scores[candidates]
+
+        boxes = np.concatenate([xywh[:, :2] - xywh[:, 2:] / 2, xywh[:, :2] + xywh[:, 2:] / 2], axis=1)
+        keep = non_max_suppression(boxes, scores, classes, self.iou, self.max_detections)
+        boxes = (boxes[keep] - np.array([pad[0], pad[1], pad[0], pad[1]])) / gain
+        boxes = np.clip(boxes, 0, [shape[1], shape[0], shape[1], shape[0]])
+        return Detections(self.names, [
+            DetectedBox(int(cls), float(score), box.tolist())
+            for cls, score, box in zip(classes[keep], scores[keep], boxes)
+        ])
+
+
+# ==========================
+# Batched detection service
+# ==========================
+class DetectorBusy(RuntimeError):
+    """The detection queue is full, the caller should ask the user to retry."""
+
+
+class CardDetectionService:
+    """
+    Runs the card model in a worker thread and batches concurrent requests.
+
+    The worker first loads the model with `model_loader` and warms it up with one dummy
+    inference; photos sent before that wait in the queue (see `ready`). After that it
+    waits for a request, then keeps collecting until `batch_window` seconds
+    have passed or `max_batch` photos are waiting, and runs them through the model in
+    one call. At most `max_queue` requests may wait; beyond that `detect` raises
+    DetectorBusy instead of letting the backlog (and everyone's latency) grow.
+    """
+
+    def __init__(self, model_loader, max_batch=8, batch_window=0.005, max_queue=32, use_contours=False,
+                 image_size=MODEL_IMAGE_SIZE, crop_table=False, cache=None, latency_samples=1000):
+        self.model_loader = model_loader
+        self.model = None
+        self.ready = threading.Event()  # set once the model is loaded (or failed to load)
+        self.load_error = None
+        self.load_seconds = None
+        self.warm_up_seconds = None
+        self.use_contours = use_contours
+        self.image_size = image_size
+        self.crop_table = crop_table
+        self.cache = cache
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self.requests = 0
+        self.rejected = 0
+        self.batches = 0
+        self.failures = 0
+        self._wait_times = deque(maxlen=latency_samples)  # seconds in the queue
+        self._latencies = deque(maxlen=latency_samples)  # seconds from detect() to the result
+        self._batch_sizes = deque(maxlen=latency_samples)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="card-detector", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    async def detect(self, image, file_id=None, chat_id=None):
+        """
+        מזהה את הקלפים בתמונה ומחזירה את התוויות השונות (כמו identify_cards).
+        `image` may be still encoded (bytes), it is then decoded in the worker thread.
+        With a cache and the photo's `file_id` (file_unique_id) the result is cached, and with
+        `chat_id` a photo identical to one cached for the chat may skip the model (see
+        DetectionCache.match_similar).
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        try:
+            self._queue.put_nowait((image, file_id, chat_id, loop, future, time.perf_counter()))
+        except queue.Full:
+            self.rejected += 1
+            raise DetectorBusy("יותר מדי תמונות בתור לזיהוי, נסה שוב בעוד רגע.") from None
+        self.requests += 1
+        return await future
+
+    def _collect_batch(self):
+        """Blocks for the first request, then gathers more until the window closes or the batch is full."""
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.perf_counter() + self.batch_window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                self._queue.put(None)  # stop after this batch
+                break
+            batch.append(request)
+        return batch
+
+    def _load_model(self):
+        started = time.perf_counter()
+        try:
+            self.model = self.model_loader()
+            loaded = time.perf_counter()
+            self.model(np.zeros((640, 640, 3), dtype=np.uint8))  # the first call initializes the runtime
+        except Exception as e:
+            self.load_error = e
+            print(f"Card model failed to load: {e}")
+        else:
+            self.load_seconds = loaded - started
+            self.warm_up_seconds = time.perf_counter() - loaded
+            print(f"Card model ready (load {self.load_seconds:.2f}s, warm-up {self.warm_up_seconds:.2f}s)")
+        finally:
+            self.ready.set()
+
+    def _run(self):
+        self._load_model()
+        while True:
+            batch = self._collect_batch()
+            if batch is None:
+                return
+            started = time.perf_counter()
+            self.batches += 1
+            self._batch_sizes.append(len(batch))
+            outcomes = [None] * len(batch)
+            images = []
+            to_cache = []  # (file_id, cards, similar photo key) written after the results are sent
+            for i, (image, file_id, chat_id, _, _, _) in enumerate(batch):
+                try:
+                    image = load_image(image)
+                except ValueError as e:
+                    outcomes[i] = (None, e)  # only this photo fails
+                    continue
+                key = None
+                if self.cache is not None and self.cache.match_similar and chat_id is not None:
+                    key = similar_photo_key(chat_id, image, image_hash(image))
+                cached = self.cache.find_similar(key) if key is not None else None
+                if cached is not None:
+                    outcomes[i] = ([label for label, _ in cached], None)
+                    to_cache.append((file_id, cached, key))
+                else:
+                    images.append((i, image, file_id, key))
+            try:
+                if images and self.load_error is not None:
+                    raise RuntimeError("מודל זיהוי הקלפים לא נטען") from self.load_error
+                if images:
+                    results = self.model([preprocess_image(image, self.image_size, self.crop_table)
+                                          for _, image, _, _ in images])
+                    detected = [card_detections(result, image, self.use_contours)
+                                for (_, image, _, _), result in zip(images, results)]
+                    for (i, _, file_id, key), cards in zip(images, detected):
+                        outcomes[i] = ([label for label, _ in cards], None)
+                        if self.cache is not None and file_id:
+                            to_cache.append((file_id, cards, key))
+            except Exception as e:
+                self.failures += 1
+                for i, _, _, _ in images:
+                    outcomes[i] = (None, e)
+
+            finished = time.perf_counter()
+            for (_, _, _, loop, future, enqueued_at), (cards, error) in zip(batch, outcomes):
+                self._wait_times.append(started - enqueued_at)
+                self._latencies.append(finished - enqueued_at)
+                loop.call_soon_threadsafe(_resolve, future, cards, error)
+            for entry in to_cache:
+                self.cache.put(*entry)
+
+    def stats(self):
+        def milliseconds(samples, q):
+            return float(np.percentile(samples, q) * 1000) if samples else 0.0
+
+        latencies, wait_times = list(self._latencies), list(self._wait_times)
+        return {
+            "model_ready": self.ready.is_set() and self.load_error is None,
+            "model_load_s": self.load_seconds,
+            "model_warm_up_s": self.warm_up_seconds,
+            "requests": self.requests,
+            "rejected": self.rejected,
+            "failures": self.failures,
+            "batches": self.batches,
+            "queued": self._queue.qsize(),
+            "mean_batch_size": float(np.mean(self._batch_sizes)) if self._batch_sizes else 0.0,
+            "wait_p50_ms": milliseconds(wait_times, 50),
+            "latency_p50_ms": milliseconds(latencies, 50),
+            "latency_p99_ms": milliseconds(latencies, 99),
+        }
+
+
+def _resolve(future, cards, error):
+    if future.cancelled():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(cards)
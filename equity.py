@@ -0,0 +1,991 @@
+"""
+Batched equity engine for the bot.
+
+Cards are handled as integer indices 0..51 (rank * 4 + suit) so that whole
+batches of deals can be sampled and ranked with NumPy at once instead of one
+`treys` evaluation per hand.  A hand is packed into a 64-bit card-set mask
+(one 13-bit rank mask per suit), which lets the known board be combined with
+every sampled runout and opponent hand by a single OR.
+
+7-card hands are ranked with lookup tables indexed by 13-bit rank masks
+(straights, highest card, top-k kickers).  The resulting value is an int where
+a higher value means a stronger hand; `hand_classes` maps values back to the
+same hand classes `treys` reports ("Royal Flush" ... "High Card").
+"""
+import functools
+import itertools
+import math
+import os
+import sys
+import time
+from collections import OrderedDict
+
+import numpy as np
+from treys import Card
+from treys.lookup import LookupTable
+
+# ==========================
+# Card encoding
+# ==========================
+SUIT_INDEX = {1: 0, 2: 1, 4: 2, 8: 3}  # treys suit bits (s, h, d, c) -> 0..3
+INDEX_TO_CARD = [Card.new(f"{rank}{suit}") for rank in Card.STR_RANKS for suit in "shdc"]
+
+# treys hand classes, strongest first (index == treys rank class)
+HAND_CLASSES = tuple(LookupTable.RANK_CLASS_TO_STRING[i] for i in range(10))
+
+
+def card_to_index(card):
+    """ממירה קלף בפורמט treys לאינדקס 0..51"""
+    return Card.get_rank_int(card) * 4 + SUIT_INDEX[Card.get_suit_int(card)]
+
+
+def cards_to_indices(cards):
+    return np.array([card_to_index(card) for card in cards], dtype=np.int8)
+
+
+def parse_card_input(card_str):
+    """ממירה את הקלט של הקלף לפורמט מתאים """
+    
+    # המרה לאותיות גדולות וניקוי רווחים
+    card_str = card_str.strip().upper()
+
+    # המרה של "10" ל-"T" כדי להתאים לפורמט של STR_RANKS
+    card_str = card_str.replace("10", "T")
+
+    # בדיקת תקינות פורמט הקלט
+    if len(card_str) != 2:
+        raise ValueError(f"קלט לא תקין עבור הקלף: {card_str}")
+    
+    # פיצול לרמה וסוג
+    rank, suit = card_str[0], card_str[1].lower()  # סוג הקלף באות קטנה כדי להתאים למיפוי
+
+    # המרה לפורמט מתאים
+    return Card.new(f"{rank}{suit}")
+
+
+# ==========================
+# Lookup tables (by 13-bit rank mask)
+# ==========================
+RANK_BITS = (1 << np.arange(13)).astype(np.int32)
+KICKER_BASE = 13 ** 5  # hand value = category * KICKER_BASE + kicker
+
+
+def _build_tables():
+    size = 1 << 13
+    high_bit = np.zeros(size, dtype=np.int32)
+    popcount = np.zeros(size, dtype=np.int32)
+    straight_high = np.full(size, -1, dtype=np.int32)
+    top = {k: np.zeros(size, dtype=np.int32) for k in (2, 3, 5)}
+
+    # straight windows, highest first; the wheel (A-2-3-4-5) is ranked as 5-high
+    windows = [(0x1F << low, low + 4) for low in range(8, -1, -1)] + [(0x100F, 3)]
+
+    for mask in range(1, size):
+        ranks = [r for r in range(12, -1, -1) if mask >> r & 1]
+        high_bit[mask] = ranks[0]
+        popcount[mask] = len(ranks)
+        for k, table in top.items():
+            value = 0
+            for r in (ranks + [0] * k)[:k]:
+                value = value * 13 + r
+            table[mask] = value
+        for window, high in windows:
+            if mask & window == window:
+                straight_high[mask] = high
+                break
+
+    return high_bit, popcount, straight_high, top[2], top[3], top[5]
+
+
+HIGH_BIT, POPCOUNT, STRAIGHT_HIGH, TOP2, TOP3, TOP5 = _build_tables()
+
+# each card is one bit of a 64-bit card-set mask: suit * 16 + rank
+CARD_MASKS = np.array([1 << (index % 4 * 16 + index // 4) for index in range(52)], dtype=np.int64)
+
+# category (0 = high card .. 8 = straight flush) -> treys rank class
+_CATEGORY_TO_CLASS = np.array([9, 8, 7, 6, 5, 4, 3, 2, 1], dtype=np.int8)
+
+
+def hand_masks(cards):
+    """ממירה מערך (N, K) של אינדקסי קלפים למסכות קבוצת קלפים"""
+    card_masks = CARD_MASKS[np.asarray(cards, dtype=np.int8)]
+    masks = np.zeros(card_masks.shape[:-1], dtype=np.int64)
+    for column in range(card_masks.shape[-1]):
+        masks |= card_masks[..., column]
+    return masks
+
+
+def evaluate_hands(cards):
+    """
+    Ranks a batch of hands given as an (N, 7) array of card indices.
+    Returns an int32 array of N hand values, higher is stronger.
+    """
+    return evaluate_masks(hand_masks(cards))
+
+
+def evaluate_masks(masks):
+    """Ranks a batch of 7-card hands given as card-set masks (see `hand_masks`)."""
+    masks = np.asarray(masks, dtype=np.int64)
+    spades = (masks & 0x1FFF).astype(np.int32)
+    hearts = (masks >> 16 & 0x1FFF).astype(np.int32)
+    diamonds = (masks >> 32 & 0x1FFF).astype(np.int32)
+    clubs = (masks >> 48 & 0x1FFF).astype(np.int32)
+
+    # rank multiplicities straight from the per-suit rank masks
+    ranks_mask = spades | hearts | diamonds | clubs
+    quads = spades & hearts & diamonds & clubs
+    at_least_three = (spades & hearts & (diamonds | clubs)) | ((spades | hearts) & diamonds & clubs)
+    at_least_two = (spades & (hearts | diamonds | clubs)) | (hearts & (diamonds | clubs)) | (diamonds & clubs)
+    trips = at_least_three & ~quads
+    pairs = at_least_two & ~at_least_three
+
+    flush_mask = np.select(
+        [POPCOUNT[spades] >= 5, POPCOUNT[hearts] >= 5, POPCOUNT[diamonds] >= 5, POPCOUNT[clubs] >= 5],
+        [spades, hearts, diamonds, clubs],
+        default=0,
+    )
+    has_flush = flush_mask != 0
+
+    straight_flush = STRAIGHT_HIGH[flush_mask]
+    straight = STRAIGHT_HIGH[ranks_mask]
+
+    quad = HIGH_BIT[quads]
+    trip = HIGH_BIT[trips]
+    rest_trips = trips & ~RANK_BITS[trip]
+    pair = HIGH_BIT[pairs]
+    second_pair = HIGH_BIT[pairs & ~RANK_BITS[pair]]
+
+    conditions = [
+        straight_flush >= 0,
+        quads != 0,
+        (trips != 0) & ((rest_trips | pairs) != 0),
+        has_flush,
+        straight >= 0,
+        trips != 0,
+        POPCOUNT[pairs] >= 2,
+        pairs != 0,
+    ]
+    values = [
+        8 * KICKER_BASE + straight_flush,
+        7 * KICKER_BASE + quad * 13 + HIGH_BIT[ranks_mask & ~quads],
+        6 * KICKER_BASE + trip * 13 + HIGH_BIT[rest_trips | pairs],
+        5 * KICKER_BASE + TOP5[flush_mask],
+        4 * KICKER_BASE + straight,
+        3 * KICKER_BASE + trip * 169 + TOP2[ranks_mask & ~trips],
+        2 * KICKER_BASE + (pair * 13 + second_pair) * 13
+        + HIGH_BIT[ranks_mask & ~RANK_BITS[pair] & ~RANK_BITS[second_pair]],
+        1 * KICKER_BASE + pair * 2197 + TOP3[ranks_mask & ~pairs],
+    ]
+    return np.select(conditions, values, default=TOP5[ranks_mask]).astype(np.int32)
+
+
+def hand_classes(values):
+    """ממירה ערכי ידיים למחלקות של treys (0 = Royal Flush ... 9 = High Card)"""
+    values = np.asarray(values)
+    classes = _CATEGORY_TO_CLASS[values // KICKER_BASE]
+    return np.where(values == 8 * KICKER_BASE + 12, 0, classes)
+
+
+def class_histogram(values, weights=None):
+    return np.bincount(hand_classes(values), weights=weights, minlength=len(HAND_CLASSES))
+
+
+# ==========================
+# Results
+# ==========================
+def build_hand_stats(player_classes, opponent_classes, single_opponent_classes):
+    """Hand-type percentages in the (player, best opponent, heads-up opponent) format used by the bot."""
+    hand_stats = {}
+    for hand_class, hand_type in enumerate(HAND_CLASSES):
+        player_percent = float(player_classes[hand_class] * 100)
+        opponent_percent = float(opponent_classes[hand_class] * 100) if opponent_classes is not None else 0
+        single_opponent_percent = float(single_opponent_classes[hand_class] * 100)
+
+        # סינון תוצאות קרובות ל-0%
+        if player_percent > 0.01 or opponent_percent > 0.01 or single_opponent_percent > 0.01:
+            hand_stats[hand_type] = (player_percent, opponent_percent, single_opponent_percent)
+    return hand_stats
+
+
+def win_stderr(probability, num_samples):
+    """Standard error (in percent) of a win rate given in percent and estimated from `num_samples` deals."""
+    if probability is None or not num_samples:
+        return None
+    p = probability / 100
+    return math.sqrt(p * (1 - p) / num_samples) * 100
+
+
+def equity_result(player_classes, opponent_classes, single_opponent_classes,
+                  multi_win_probability, multi_tie_probability,
+                  single_win_probability, single_tie_probability,
+                  num_simulations, exact, multi_win_stderr=0.0, single_win_stderr=0.0):
+    """
+    Packs an equity computation into the dict returned by this module.
+    Class distributions are fractions per entry of HAND_CLASSES, probabilities and their
+    standard errors are in percent (the error is 0 for exact numbers); the multi-way fields
+    are None when there is a single opponent and ties are None when unknown.
+    """
+    return {
+        "player_classes": player_classes,
+        "opponent_classes": opponent_classes,
+        "single_opponent_classes": single_opponent_classes,
+        "hand_stats": build_hand_stats(player_classes, opponent_classes, single_opponent_classes),
+        "multi_win_probability": multi_win_probability,
+        "multi_tie_probability": multi_tie_probability,
+        "single_win_probability": single_win_probability,
+        "single_tie_probability": single_tie_probability,
+        "multi_win_stderr": multi_win_stderr if multi_win_probability is not None else None,
+        "single_win_stderr": single_win_stderr,
+        "num_simulations": num_simulations,
+        "exact": exact,
+    }
+
+
+# ==========================
+# Hand state
+# ==========================
+def _combinations(cards, k):
+    combinations = list(itertools.combinations(cards.tolist(), k))
+    return np.array(combinations, dtype=np.int8).reshape(len(combinations), k)
+
+
+# all 1326 two-card combos; opponent hands and ranges are indexed by position in this table
+ALL_COMBOS = _combinations(np.arange(52, dtype=np.int8), 2)
+ALL_COMBO_MASKS = CARD_MASKS[ALL_COMBOS[:, 0]] | CARD_MASKS[ALL_COMBOS[:, 1]]
+
+
+class HandState:
+    """
+    The known cards of one hand, kept alive from street to street.
+
+    Holds the dead-card mask, the board mask the evaluator ORs into every sampled hand,
+    the live cards left to deal and the table of possible opponent hands (with their
+    position in ALL_COMBOS, used to look up range weights). `advance`
+    only folds the newly dealt board cards into these, and the results of earlier
+    streets are kept in `results` (by number of board cards).
+    """
+
+    def __init__(self, hole_cards, community_cards=()):
+        self.hole_cards = list(hole_cards)
+        self.community_cards = []
+        self.hole = cards_to_indices(self.hole_cards)
+        self.board = np.zeros(0, dtype=np.int8)
+        self.hole_mask = int(hand_masks(self.hole))
+        self.board_mask = 0
+        self.live_cards = np.setdiff1d(np.arange(52, dtype=np.int8), self.hole)
+        self.opponent_ids = np.flatnonzero((ALL_COMBO_MASKS & self.hole_mask) == 0)
+        self.opponent_combos = ALL_COMBOS[self.opponent_ids]
+        self.opponent_masks = ALL_COMBO_MASKS[self.opponent_ids]
+        self.results = {}
+        self.advance(community_cards)
+
+    def can_advance(self, hole_cards, community_cards):
+        """האם הקלפים הם המשך של היד הזו (אותם קלפי חור, והלוח הנוכחי הוא תחילת הלוח החדש)"""
+        current = len(self.community_cards)
+        return list(hole_cards) == self.hole_cards and list(community_cards[:current]) == self.community_cards
+
+    def advance(self, community_cards):
+        """Moves to a later street, `community_cards` must extend the current board."""
+        if not self.can_advance(self.hole_cards, community_cards):
+            raise ValueError("קלפי הקהילה אינם המשך של הלוח הנוכחי")
+        new_cards = cards_to_indices(community_cards[len(self.community_cards):])
+        if new_cards.size == 0:
+            return
+        if np.isin(new_cards, self.live_cards, invert=True).any() or np.unique(new_cards).size != new_cards.size:
+            raise ValueError("קלף שכבר ידוע הוזן שוב")
+
+        new_mask = int(hand_masks(new_cards))
+        self.community_cards = list(community_cards)
+        self.board = np.concatenate([self.board, new_cards])
+        self.board_mask |= new_mask
+        self.live_cards = self.live_cards[np.isin(self.live_cards, new_cards, invert=True)]
+
+        keep = (self.opponent_masks & new_mask) == 0
+        self.opponent_ids = self.opponent_ids[keep]
+        self.opponent_combos = self.opponent_combos[keep]
+        self.opponent_masks = self.opponent_masks[keep]
+
+    def previous_result(self):
+        """התוצאה של הרחוב האחרון שלפני הרחוב הנוכחי, או None"""
+        earlier = [count for count in self.results if count < len(self.community_cards)]
+        return self.results[max(earlier)] if earlier else None
+
+
+# ==========================
+# Monte Carlo simulation
+# ==========================
+DEFAULT_SIMULATIONS = 100000
+BATCH_SIZE = 20000
+
+
+MAX_RANGE_REJECTIONS = 8  # quick redraws of a hand that clashes, before drawing it from the masked range
+RANGE_MASK_ROWS = 2048  # deals per masked draw (rows x combos weights in memory)
+MAX_RANGE_RESTARTS = 5  # redeals of the deals in which a later opponent has no hand left
+
+
+def deal_cards(rng, live_cards, n, k, size=None):
+    """
+    Draws k distinct cards out of `live_cards` for each of n deals at once
+    (a partial Fisher-Yates shuffle applied to all rows together).
+    `live_cards` may also be one deck per row, of which only the first `size` cards are dealt.
+    """
+    deck = np.tile(live_cards, (n, 1)) if live_cards.ndim == 1 else live_cards.copy()
+    size = deck.shape[1] if size is None else size
+    rows = np.arange(n)
+    for i in range(k):
+        j = rng.integers(i, size, size=n)
+        drawn = deck[rows, j]
+        deck[rows, j] = deck[:, i]
+        deck[:, i] = drawn
+    return deck[:, :k]
+
+
+def range_samplers(weights):
+    """
+    Per opponent, for `deal_range_hands`: the combos in range, their weights and the running
+    sum of the weights (None when the weights are all equal).
+    """
+    samplers = []
+    for opponent in weights:
+        combos = np.flatnonzero(opponent)
+        combo_weights = opponent[combos].astype(np.float64)
+        equal = (combo_weights == combo_weights[0]).all()
+        samplers.append((combos, combo_weights, None if equal else np.cumsum(combo_weights)))
+    return samplers
+
+
+def _draw_weighted(rng, weights, cumulative, n):
+    """n positions drawn by `weights` (with their running sum `cumulative`, None for equal weights)"""
+    if cumulative is None:
+        return rng.integers(0, weights.size, size=n)
+    drawn = np.searchsorted(cumulative, rng.random(n) * cumulative[-1], side="right")
+    return np.minimum(drawn, weights.size - 1)
+
+
+def _draw_masked(rng, combo_masks, weights, used):
+    """
+    One position per deal, drawn by the weights renormalized over the combos that share no
+    card with the deal's `used` mask; -1 for a deal in which no combo is left.
+    """
+    picks = np.empty(used.size, dtype=np.intp)
+    for start in range(0, used.size, RANGE_MASK_ROWS):
+        rows = slice(start, start + RANGE_MASK_ROWS)
+        row_cumulative = np.cumsum(np.where((combo_masks & used[rows, None]) == 0, weights, 0.0), axis=1)
+        totals = row_cumulative[:, -1]
+        drawn = (row_cumulative <= (rng.random(totals.size) * totals)[:, None]).sum(axis=1)
+        picks[rows] = np.where(totals > 0, np.minimum(drawn, weights.size - 1), -1)
+    return picks
+
+
+def deal_range_hands(rng, hand, samplers, n):
+    """
+    Deals the opponents their hands one at a time in each of n deals: every hand is drawn by
+    the opponent's combo weights (see `range_samplers`) among the combos that share no card
+    with the hands already dealt. A clashing draw is first simply redrawn, and after
+    MAX_RANGE_REJECTIONS it is drawn from the range masked by the dealt cards, so crowded
+    tables with overlapping ranges still deal. A deal that leaves a later opponent with no
+    possible hand is dealt again, up to MAX_RANGE_RESTARTS times, and then replaced by a copy
+    of a completed deal (the deals are conditioned on completing).
+    Returns the (n, opponents) positions of the hands in `hand.opponent_masks`.
+    """
+    picked = np.zeros((n, len(samplers)), dtype=np.intp)
+    pending = np.arange(n)
+    for _ in range(MAX_RANGE_RESTARTS):
+        used = np.zeros(pending.size, dtype=np.int64)
+        dealt = np.ones(pending.size, dtype=bool)
+        for i, (combos, weights, cumulative) in enumerate(samplers):
+            combo_masks = hand.opponent_masks[combos]
+            draws = np.full(pending.size, -1, dtype=np.intp)
+            todo = np.flatnonzero(dealt)
+            for _ in range(MAX_RANGE_REJECTIONS):
+                if todo.size == 0:
+                    break
+                tries = _draw_weighted(rng, weights, cumulative, todo.size)
+                clear = (combo_masks[tries] & used[todo]) == 0
+                draws[todo[clear]] = tries[clear]
+                todo = todo[~clear]
+            if todo.size:
+                draws[todo] = _draw_masked(rng, combo_masks, weights, used[todo])
+            dealt &= draws >= 0
+            rows = np.flatnonzero(dealt)
+            picked[pending[rows], i] = combos[draws[rows]]
+            used[rows] |= combo_masks[draws[rows]]
+        pending = pending[~dealt]
+        if pending.size == 0:
+            return picked
+    completed = np.setdiff1d(np.arange(n), pending)
+    if completed.size == 0:
+        raise ValueError("הטווחים של היריבים חופפים מדי כדי לחלק להם ידיים")
+    picked[pending] = picked[rng.choice(completed, pending.size)]
+    return picked
+
+
+def deal_runouts(rng, live_cards, dealt_masks, k):
+    """
+    Draws k board cards per deal out of the live cards minus that deal's `dealt_masks`: each
+    deal gets its own deck with the dealt cards moved to the end, out of reach of the shuffle.
+    """
+    dealt = (dealt_masks[:, None] & CARD_MASKS[live_cards][None, :]) != 0
+    decks = live_cards[np.argsort(dealt, axis=1, kind="stable")]
+    return hand_masks(deal_cards(rng, decks, dealt_masks.size, k, size=live_cards.size - dealt.sum(axis=1)))
+
+
+def simulate_equity(hand, opponent_count, num_simulations=DEFAULT_SIMULATIONS, rng=None,
+                    target_stderr=None, time_budget=None, ranges=None):
+    """
+    Monte Carlo equity of a `HandState` against `opponent_count` hands, random or drawn
+    from the opponents' `ranges` (see `opponent_weights`). Every deal is shared by both
+    estimates: the heads-up numbers are against the first opponent of the multi-way deal.
+    Returns an `equity_result` dict.
+
+    Deals are simulated in batches of BATCH_SIZE up to `num_simulations`. In anytime mode
+    sampling stops early once the standard error of the win rates is at most `target_stderr`
+    (percent) or after `time_budget` seconds, whichever comes first.
+    """
+    started = time.monotonic()
+    rng = rng if rng is not None else np.random.default_rng()
+    live_cards = hand.live_cards
+    missing = 5 - hand.board.size
+    multi_way = opponent_count > 1
+    weights = opponent_weights(hand, ranges, opponent_count)
+    samplers = range_samplers(weights) if weights is not None else None
+
+    player_counts = np.zeros(len(HAND_CLASSES), dtype=np.int64)
+    opponent_counts = np.zeros(len(HAND_CLASSES), dtype=np.int64) if multi_way else None
+    single_opponent_counts = np.zeros(len(HAND_CLASSES), dtype=np.int64)
+    multi_player_wins = multi_player_ties = 0
+    single_opponent_wins = single_opponent_ties = 0
+
+    hole_mask = hand.hole_mask
+    board_mask = hand.board_mask
+
+    simulated = 0
+    while simulated < num_simulations:
+        n = min(BATCH_SIZE, num_simulations - simulated)
+        if weights is None:
+            # deal layout per row: runout, then one hand per opponent
+            deal = deal_cards(rng, live_cards, n, missing + 2 * opponent_count)
+            full_board = board_mask | hand_masks(deal[:, :missing])
+            opponent_hands = hand_masks(deal[:, missing:].reshape(n, opponent_count, 2))
+        else:
+            # opponents first (from their ranges), then the runout from the cards they left
+            picked = deal_range_hands(rng, hand, samplers, n)
+            opponent_hands = hand.opponent_masks[picked]
+            full_board = board_mask | deal_runouts(rng, live_cards, np.bitwise_or.reduce(opponent_hands, axis=1), missing)
+
+        player_values = evaluate_masks(full_board | hole_mask)
+        player_counts += class_histogram(player_values)
+        opponent_values = evaluate_masks(opponent_hands | full_board[:, None])
+
+        if multi_way:
+            opponent_best = opponent_values.max(axis=1)
+            opponent_counts += class_histogram(opponent_best)
+            multi_player_wins += int((player_values > opponent_best).sum())
+            multi_player_ties += int((player_values == opponent_best).sum())
+
+        single_opponent_values = opponent_values[:, 0]
+        single_opponent_counts += class_histogram(single_opponent_values)
+        single_opponent_wins += int((player_values > single_opponent_values).sum())
+        single_opponent_ties += int((player_values == single_opponent_values).sum())
+        simulated += n
+
+        if time_budget is not None and time.monotonic() - started >= time_budget:
+            break
+        if target_stderr is not None:
+            errors = [win_stderr(single_opponent_wins / simulated * 100, simulated)]
+            if multi_way:
+                errors.append(win_stderr(multi_player_wins / simulated * 100, simulated))
+            if max(errors) <= target_stderr:
+                break
+
+    multi_win_probability = multi_player_wins / simulated * 100 if multi_way else None
+    multi_tie_probability = multi_player_ties / simulated * 100 if multi_way else None
+    single_win_probability = single_opponent_wins / simulated * 100
+    return equity_result(
+        player_counts / simulated,
+        opponent_counts / simulated if multi_way else None,
+        single_opponent_counts / simulated,
+        multi_win_probability, multi_tie_probability,
+        single_win_probability, single_opponent_ties / simulated * 100,
+        simulated, exact=False,
+        multi_win_stderr=win_stderr(multi_win_probability, simulated),
+        single_win_stderr=win_stderr(single_win_probability, simulated),
+    )
+
+
+# ==========================
+# Exact enumeration
+# ==========================
+EXACT_ENUMERATION_LIMIT = 500000  # max (runout, opponent hands) deals to enumerate
+
+
+def count_deals(live_count, missing, opponent_count, combo_count=None):
+    """
+    מספר החלוקות האפשריות: השלמות לוח כפול צירופי ידיים (לא מסודרים) ליריבים.
+    With `combo_count` (the combos in a range) it is an upper bound instead.
+    """
+    deals = math.comb(live_count, missing)
+    remaining = live_count - missing
+    for i in range(opponent_count):
+        deals *= math.comb(remaining - 2 * i, 2) if combo_count is None else combo_count
+    return deals // math.factorial(opponent_count)
+
+
+def enumerate_equity(hand, opponent_count, limit=EXACT_ENUMERATION_LIMIT, ranges=None):
+    """
+    Exact equity of a `HandState` by walking every runout and every heads-up opponent hand,
+    each deal weighted by the opponents' `ranges` (see `opponent_weights`).
+    The multi-way fields are enumerated too when `count_deals` for `opponent_count`
+    opponents fits in `limit` and all opponents share one range, otherwise they are left
+    as None for the caller to sample.
+    """
+    live_cards = hand.live_cards
+    missing = 5 - hand.board.size
+    weights = opponent_weights(hand, ranges, opponent_count)
+    combos = hand.opponent_masks
+    combo_weights = np.ones(combos.size) if weights is None else weights[0]
+    shared_range = weights is None or all(np.array_equal(opponent, weights[0]) for opponent in weights[1:])
+    in_range = combo_weights > 0
+    combos, combo_weights = combos[in_range], combo_weights[in_range]
+
+    runouts = hand.board_mask | hand_masks(_combinations(live_cards, missing))
+    player_values = evaluate_masks(runouts | hand.hole_mask)
+
+    # every (runout, opponent hand) pair that does not share a card
+    runout_index, combo_index = np.nonzero((runouts[:, None] & combos[None, :]) == 0)
+    single_values = evaluate_masks(runouts[runout_index] | combos[combo_index])
+    hero_values = player_values[runout_index]
+    deal_weights = combo_weights[combo_index]
+
+    opponent_classes = multi_win_probability = multi_tie_probability = None
+    exact = True
+    if opponent_count > 1:
+        combo_count = combos.size if weights is not None else None
+        if shared_range and count_deals(live_cards.size, missing, opponent_count, combo_count) <= limit:
+            # extend each deal by one more opponent hand at a time, in increasing combo order
+            used = runouts[runout_index] | combos[combo_index]
+            last = combo_index
+            best = single_values
+            multi_weights = deal_weights
+            for _ in range(opponent_count - 1):
+                free = ((used[:, None] & combos[None, :]) == 0) & (np.arange(combos.size) > last[:, None])
+                deal_index, last = np.nonzero(free)
+                runout_index = runout_index[deal_index]
+                values = evaluate_masks(runouts[runout_index] | combos[last])
+                best = np.maximum(best[deal_index], values)
+                used = used[deal_index] | combos[last]
+                multi_weights = multi_weights[deal_index] * combo_weights[last]
+            if best.size == 0:
+                raise ValueError("הטווחים של היריבים חופפים מדי כדי לחלק להם ידיים")
+
+            multi_hero = player_values[runout_index]
+            opponent_classes = class_histogram(best, multi_weights) / multi_weights.sum()
+            multi_win_probability = float(np.average(multi_hero > best, weights=multi_weights) * 100)
+            multi_tie_probability = float(np.average(multi_hero == best, weights=multi_weights) * 100)
+        else:
+            exact = False
+
+    # with random opponents every runout appears in the same number of deals, so weighting
+    # the player's classes by deal is the same as counting each runout once
+    return equity_result(
+        class_histogram(hero_values, deal_weights) / deal_weights.sum(),
+        opponent_classes,
+        class_histogram(single_values, deal_weights) / deal_weights.sum(),
+        multi_win_probability, multi_tie_probability,
+        float(np.average(hero_values > single_values, weights=deal_weights) * 100),
+        float(np.average(hero_values == single_values, weights=deal_weights) * 100),
+        0, exact,
+    )
+
+
+# ==========================
+# Preflop table
+# ==========================
+PREFLOP_TABLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "preflop_equity.npz")
+MAX_TABLE_OPPONENTS = 8  # up to 9 players at the table
+
+
+def preflop_hands():
+    """169 הידיים ההתחלתיות הקנוניות: זוגות, ואז suited ו-offsuit מהגבוה לנמוך"""
+    ranks = Card.STR_RANKS[::-1]
+    hands = [rank + rank for rank in ranks]
+    for i, high in enumerate(ranks):
+        for low in ranks[i + 1:]:
+            hands += [f"{high}{low}s", f"{high}{low}o"]
+    return hands
+
+
+def canonical_hand(hole_cards):
+    """ממירה שני קלפי חור לשם היד הקנוני (למשל AKs, QJo, TT)"""
+    first, second = sorted(hole_cards, key=Card.get_rank_int, reverse=True)
+    high, low = Card.STR_RANKS[Card.get_rank_int(first)], Card.STR_RANKS[Card.get_rank_int(second)]
+    if high == low:
+        return high + low
+    return f"{high}{low}{'s' if Card.get_suit_int(first) == Card.get_suit_int(second) else 'o'}"
+
+
+def representative_cards(hand):
+    """Concrete hole cards for a canonical hand name."""
+    second_suit = "s" if hand.endswith("s") else "h"
+    return [Card.new(hand[0] + "s"), Card.new(hand[1] + second_suit)]
+
+
+def build_preflop_entry(hand, num_simulations, max_opponents=MAX_TABLE_OPPONENTS, seed=None):
+    """Simulates one canonical hand against 1..max_opponents opponents (one row of the table)."""
+    rng = np.random.default_rng(seed)
+    state = HandState(representative_cards(hand))
+    entry = {
+        "opponent_classes": np.full((max_opponents + 1, len(HAND_CLASSES)), np.nan),
+        "multi_win": np.full(max_opponents + 1, np.nan),
+        "multi_tie": np.full(max_opponents + 1, np.nan),
+    }
+    for opponent_count in range(1, max_opponents + 1):
+        result = simulate_equity(state, opponent_count, num_simulations, rng)
+        if opponent_count == 1:
+            entry["player_classes"] = result["player_classes"]
+            entry["single_opponent_classes"] = result["single_opponent_classes"]
+            entry["single_win"] = result["single_win_probability"]
+            entry["single_tie"] = _nan_if_none(result["single_tie_probability"])
+        else:
+            entry["opponent_classes"][opponent_count] = result["opponent_classes"]
+            entry["multi_win"][opponent_count] = result["multi_win_probability"]
+            entry["multi_tie"][opponent_count] = _nan_if_none(result["multi_tie_probability"])
+    return entry
+
+
+def save_preflop_table(entries, num_simulations, path=PREFLOP_TABLE_PATH):
+    """Writes the per-hand entries (in `preflop_hands` order) as a compressed .npz table."""
+    np.savez_compressed(
+        path,
+        hands=np.array(preflop_hands()),
+        num_simulations=num_simulations,
+        **{key: np.array([entry[key] for entry in entries], dtype=np.float32) for key in entries[0]},
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def load_preflop_table(path=PREFLOP_TABLE_PATH):
+    """טוענת את טבלת הפריפלופ מהדיסק, או None אם היא לא קיימת"""
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as table:
+        data = {key: table[key] for key in table.files}
+    data["index"] = {hand: i for i, hand in enumerate(data["hands"].tolist())}
+    return data
+
+
+def preflop_equity(hole_cards, opponent_count):
+    """Preflop equity from the precomputed table, or None when the table does not cover the spot."""
+    table = load_preflop_table()
+    max_opponents = table["multi_win"].shape[1] - 1 if table is not None else 0
+    if not 1 <= opponent_count <= max_opponents:
+        return None
+
+    i = table["index"][canonical_hand(hole_cards)]
+    multi_way = opponent_count > 1
+    return equity_result(
+        table["player_classes"][i].astype(float),
+        table["opponent_classes"][i, opponent_count].astype(float) if multi_way else None,
+        table["single_opponent_classes"][i].astype(float),
+        _none_if_nan(table["multi_win"][i, opponent_count]) if multi_way else None,
+        _none_if_nan(table["multi_tie"][i, opponent_count]) if multi_way else None,
+        _none_if_nan(table["single_win"][i]),
+        _none_if_nan(table["single_tie"][i]),
+        int(table["num_simulations"]), exact=False,
+        multi_win_stderr=win_stderr(_none_if_nan(table["multi_win"][i, opponent_count]), int(table["num_simulations"])),
+        single_win_stderr=win_stderr(_none_if_nan(table["single_win"][i]), int(table["num_simulations"])),
+    )
+
+
+def _nan_if_none(value):
+    return np.nan if value is None else value
+
+
+def _none_if_nan(value):
+    return None if np.isnan(value) else float(value)
+
+
+# ==========================
+# Opponent ranges
+# ==========================
+RANDOM_RANGES = ("random", "any", "100%")
+
+
+@functools.lru_cache(maxsize=1)
+def hand_combo_ids():
+    """שם יד קנוני (AKs, QJo, TT) -> מערך האינדקסים של הצירופים שלו ב-ALL_COMBOS"""
+    ranks = np.asarray(ALL_COMBOS) // 4
+    suited = ALL_COMBOS[:, 0] % 4 == ALL_COMBOS[:, 1] % 4
+    names = []
+    for (low, high), same_suit in zip(ranks.tolist(), suited.tolist()):
+        name = Card.STR_RANKS[high] + Card.STR_RANKS[low]
+        names.append(name if low == high else name + ("s" if same_suit else "o"))
+    names = np.array(names)
+    return {hand: np.flatnonzero(names == hand) for hand in preflop_hands()}
+
+
+def _range_hands(token):
+    """Canonical hands of one range token: QQ, QQ+, 22-55, AK, AKs, ATs+, A2s-A5s."""
+    ranks = Card.STR_RANKS
+    token = token.upper()
+    plus = token.endswith("+")
+    token = token.rstrip("+")
+    first, _, last = token.partition("-")
+    if len(first) not in (2, 3) or any(rank not in ranks for rank in first[:2]) or first[2:] not in ("", "S", "O"):
+        raise ValueError
+    high, low, suffix = ranks.index(first[0]), ranks.index(first[1]), first[2:].lower()
+    if high < low:
+        high, low = low, high
+    if high == low and suffix:
+        raise ValueError
+
+    if last:
+        if plus or len(last) != len(first) or last[2:].lower() != suffix or any(rank not in ranks for rank in last[:2]):
+            raise ValueError
+        last_high, last_low = sorted((ranks.index(last[0]), ranks.index(last[1])), reverse=True)
+        if high == low:
+            if last_high != last_low:
+                raise ValueError
+            span = [(rank, rank) for rank in range(min(low, last_low), max(low, last_low) + 1)]
+        else:
+            if last_high != high:
+                raise ValueError
+            span = [(high, kicker) for kicker in range(min(low, last_low), max(low, last_low) + 1)]
+    elif plus:
+        # pairs go up to AA, other hands raise the kicker up to one below the high card
+        span = [(rank, rank) for rank in range(low, 13)] if high == low else \
+            [(high, kicker) for kicker in range(low, high)]
+    else:
+        span = [(high, low)]
+
+    hands = []
+    for high, low in span:
+        name = ranks[high] + ranks[low]
+        if high == low:
+            hands.append(name)
+        else:
+            hands += [name + suffix] if suffix else [name + "s", name + "o"]
+    return hands
+
+
+@functools.lru_cache(maxsize=1)
+def hands_by_strength():
+    """169 הידיים מהחזקה לחלשה, לפי סיכויי הניצחון heads-up בטבלת הפריפלופ"""
+    table = load_preflop_table()
+    if table is None:
+        raise ValueError("אין טבלת פריפלופ לדירוג ידיים, השתמש בטווח מפורש (למשל QQ+,AKs)")
+    hands = table["hands"].tolist()
+    return [hands[i] for i in np.argsort(-table["single_win"], kind="stable").tolist()]
+
+
+def top_range(percent):
+    """The strongest starting hands that together make up `percent` of all combos."""
+    weights = np.zeros(len(ALL_COMBOS))
+    target = len(ALL_COMBOS) * percent / 100
+    combo_ids = hand_combo_ids()
+    for hand in hands_by_strength():
+        if np.count_nonzero(weights) >= target:
+            break
+        weights[combo_ids[hand]] = 1.0
+    return weights
+
+
+@functools.lru_cache(maxsize=256)
+def parse_range(text):
+    """
+    Parses an opponent range into a weight per entry of ALL_COMBOS.
+
+    Accepts "top 20%" / "20%" (the strongest hands by the preflop table), "random", or
+    comma-separated hands such as "QQ+,AKs,ATs+,KQo,22-55,A2s-A5s", each optionally
+    weighted by a frequency ("AKo:0.5"). The result is cached and read-only.
+    """
+    normalized = text.strip().lower()
+    if normalized in RANDOM_RANGES:
+        weights = np.ones(len(ALL_COMBOS))
+    elif normalized.endswith("%"):
+        try:
+            percent = float(normalized.removeprefix("top").rstrip("%"))
+        except ValueError:
+            raise ValueError(f"טווח לא תקין: {text}") from None
+        if not 0 < percent <= 100:
+            raise ValueError(f"אחוז הטווח חייב להיות בין 0 ל-100: {text}")
+        weights = top_range(percent)
+    else:
+        weights = np.zeros(len(ALL_COMBOS))
+        combo_ids = hand_combo_ids()
+        for token in text.replace(" ", "").split(","):
+            hand_text, _, frequency = token.partition(":")
+            try:
+                hands = _range_hands(hand_text)
+                weight = float(frequency) if frequency else 1.0
+            except ValueError:
+                raise ValueError(f"טווח לא תקין: {token}") from None
+            if not 0 <= weight <= 1:
+                raise ValueError(f"משקל חייב להיות בין 0 ל-1: {token}")
+            for hand in hands:
+                weights[combo_ids[hand]] = weight
+
+    if not weights.any():
+        raise ValueError(f"הטווח ריק: {text}")
+    weights.flags.writeable = False
+    return weights
+
+
+def is_random_range(text):
+    return text is None or text.strip().lower() in RANDOM_RANGES
+
+
+def opponent_weights(hand, ranges, opponent_count):
+    """
+    Weights over the live opponent combos of `hand` for each of the `opponent_count`
+    opponents, from a list of range strings (missing or None entries are random hands).
+    Returns None when every opponent holds a random hand.
+    """
+    ranges = list(ranges or [])[:opponent_count]
+    ranges += [None] * (opponent_count - len(ranges))
+    if all(is_random_range(text) for text in ranges):
+        return None
+
+    weights = []
+    for text in ranges:
+        live = np.ones(hand.opponent_ids.size) if is_random_range(text) else parse_range(text)[hand.opponent_ids]
+        if not live.any():
+            raise ValueError(f"אין ידיים אפשריות בטווח {text} עם הקלפים הידועים")
+        weights.append(live)
+    return weights
+
+
+# ==========================
+# Result cache
+# ==========================
+_SUIT_PERMUTATIONS = list(itertools.permutations(range(4)))
+
+
+def equity_cache_key(hole_cards, community_cards, opponent_count, ranges=None):
+    """
+    Cache key that is identical for spots that only differ by a renaming of suits
+    (e.g. AhKh on 2h7c9d and AsKs on 2s7d9c) or by the order of cards within the
+    hole cards and within the board. Ranges are part of the key as written; they
+    never name suits, so the suit normalization still holds with them.
+    """
+    hole = [card_to_index(card) for card in hole_cards]
+    board = [card_to_index(card) for card in community_cards]
+    canonical = min(
+        (
+            tuple(sorted(card & ~3 | permutation[card & 3] for card in hole)),
+            tuple(sorted(card & ~3 | permutation[card & 3] for card in board)),
+        )
+        for permutation in _SUIT_PERMUTATIONS
+    )
+    ranges = tuple(None if is_random_range(text) else text.strip().lower() for text in ranges or [])
+    return canonical + (opponent_count, ranges) if any(ranges) else canonical + (opponent_count,)
+
+
+def _result_size(result):
+    """הערכה גסה של זיכרון שתופסת תוצאה במטמון (בבתים)"""
+    size = sys.getsizeof(result) + sys.getsizeof(result["hand_stats"])
+    for value in result.values():
+        size += value.nbytes if isinstance(value, np.ndarray) else sys.getsizeof(value)
+    return size + len(result["hand_stats"]) * 200
+
+
+class EquityCache:
+    """
+    Bounded LRU cache for equity results with an optional TTL and a memory cap.
+    Entries are evicted least-recently-used first when either `max_entries` or
+    `max_bytes` is exceeded, and lazily when older than `ttl` seconds.
+    """
+
+    def __init__(self, max_entries=5000, max_bytes=32 * 1024 * 1024, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.current_bytes = 0
+        self._entries = OrderedDict()  # key -> (result, size, stored_at)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and self.ttl is not None and time.monotonic() - entry[2] > self.ttl:
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, result):
+        if key in self._entries:
+            self._remove(key)
+        size = _result_size(result)
+        self._entries[key] = (result, size, time.monotonic())
+        self.current_bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self.current_bytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.current_bytes -= size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+def warm_up():
+    """
+    Loads the preflop table and runs one small batch through the evaluator, so that
+    the first real request in a fresh (worker) process does not pay for it.
+    """
+    load_preflop_table()
+    evaluate_hands(np.arange(7, dtype=np.int8)[None])
+
+
+def calculate_hand_equity(hand, opponent_count, num_simulations=DEFAULT_SIMULATIONS, rng=None,
+                          target_stderr=None, time_budget=None, ranges=None):
+    """
+    Reads preflop spots from the precomputed table, picks exact enumeration when the
+    deal space is small enough (turn and river) and falls back to Monte Carlo sampling
+    otherwise (flop, or preflop without a table). `target_stderr` and `time_budget`
+    are passed on to `simulate_equity`. `ranges` holds a range string per opponent
+    (see `parse_range`); the preflop table only covers random opponents.
+    """
+    weights = opponent_weights(hand, ranges, opponent_count)
+    if not hand.community_cards and weights is None:
+        result = preflop_equity(hand.hole_cards, opponent_count)
+        if result is not None:
+            return result
+
+    missing = 5 - len(hand.community_cards)
+    combo_count = np.count_nonzero(weights[0]) if weights is not None else None
+    if count_deals(hand.live_cards.size, missing, 1, combo_count) > EXACT_ENUMERATION_LIMIT:
+        return simulate_equity(hand, opponent_count, num_simulations, rng, target_stderr, time_budget, ranges)
+
+    result = enumerate_equity(hand, opponent_count, ranges=ranges)
+    if result["exact"]:
+        return result
+
+    # heads-up is exact, the multi-way part is too large to enumerate and is sampled
+    sampled = simulate_equity(hand, opponent_count, num_simulations, rng, target_stderr, time_budget, ranges)
+    return equity_result(
+        result["player_classes"], sampled["opponent_classes"], result["single_opponent_classes"],
+        sampled["multi_win_probability"], sampled["multi_tie_probability"],
+        result["single_win_probability"], result["single_tie_probability"],
+        sampled["num_simulations"], exact=False,
+        multi_win_stderr=sampled["multi_win_stderr"], single_win_stderr=0.0,
+    )
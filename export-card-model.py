@@ -0,0 +1,47 @@
+"""
+Exports the card detector to ONNX for detector.OnnxCardModel:
+
+    python export-card-model.py --model yolov8s_playing_cards-1.pt --int8
+
+Writes yolov8s_playing_cards-1.onnx (dynamic batch, so the detection service can run
+micro-batches in one call) and with --int8 also yolov8s_playing_cards-1-int8.onnx, with
+dynamically quantized weights. Point CARD_MODEL_PATH at either file to use it in the bot,
+and check it against the .pt model with compare-card-backends.py first.
+Needs ultralytics and onnx (export only), and onnxruntime for --int8.
+"""
+import argparse
+
+import onnx
+from ultralytics import YOLO
+
+
+def quantize(path, output):
+    """INT8 weights, keeping the ultralytics metadata (class names, image size) the backend reads."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(path, output, weight_type=QuantType.QUInt8)
+    metadata = {prop.key: prop.value for prop in onnx.load(path).metadata_props}
+    model = onnx.load(output)
+    onnx.helper.set_model_props(model, metadata)
+    onnx.save(model, output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the card detector to ONNX")
+    parser.add_argument("--model", default="yolov8s_playing_cards-1.pt")
+    parser.add_argument("--imgsz", type=int, default=640)
+    parser.add_argument("--static", action="store_true", help="fixed batch size of 1 instead of a dynamic batch")
+    parser.add_argument("--int8", action="store_true", help="also write an INT8-quantized copy")
+    args = parser.parse_args()
+
+    path = YOLO(args.model).export(format="onnx", imgsz=args.imgsz, dynamic=not args.static, simplify=True)
+    print(f"Saved {path}")
+
+    if args.int8:
+        output = path.replace(".onnx", "-int8.onnx")
+        quantize(path, output)
+        print(f"Saved {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""
+Offline generator for the preflop equity table read by equity.preflop_equity.
+
+Simulates each of the 169 canonical starting hands against 1..8 random opponents
+and writes preflop_equity.npz next to bot.py:
+
+    python generate-preflop-table.py --simulations 1000000 --workers 8
+"""
+import argparse
+import time
+from multiprocessing import Pool
+
+from equity import MAX_TABLE_OPPONENTS, PREFLOP_TABLE_PATH, build_preflop_entry, preflop_hands, save_preflop_table
+
+
+def build_entry(args):
+    hand, num_simulations, max_opponents, seed = args
+    return build_preflop_entry(hand, num_simulations, max_opponents, seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate the preflop equity table")
+    parser.add_argument("--simulations", type=int, default=1000000, help="simulations per hand and opponent count")
+    parser.add_argument("--max-opponents", type=int, default=MAX_TABLE_OPPONENTS)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=PREFLOP_TABLE_PATH)
+    args = parser.parse_args()
+
+    hands = preflop_hands()
+    jobs = [(hand, args.simulations, args.max_opponents, args.seed + i) for i, hand in enumerate(hands)]
+
+    start = time.perf_counter()
+    entries = []
+    with Pool(args.workers) as pool:
+        for i, entry in enumerate(pool.imap(build_entry, jobs), 1):
+            entries.append(entry)
+            print(f"{i}/{len(hands)} {hands[i - 1]}: heads-up win {entry['single_win']:.2f}% "
+                  f"({time.perf_counter() - start:.0f}s)")
+
+    save_preflop_table(entries, args.simulations, args.output)
+    print(f"Saved {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,459 @@
+"""
+MongoDB data layer of the bot, on PyMongo's asyncio client (`AsyncMongoClient`), so
+that database round-trips are awaited instead of freezing the event loop for every chat.
+
+`GameRepository` holds every query and write of the bot: loading and writing the game
+sessions (see sessions.py), the indexes, the player statistics, the chat history and
+the /summary counts. The client is created on first use, with a bounded connection pool
+(`max_pool_size`, `min_pool_size`, `max_idle_ms`) and a deadline for every operation
+(`timeout_ms`, longer for whole-history aggregations and index builds). `PoolMetrics`
+counts connections and checkouts for `stats`. Sessions are written in transactions, so
+MongoDB must run as a replica set (Atlas always does).
+
+All methods must be awaited on the same event loop (the bot's); code in other threads
+uses `asyncio.run_coroutine_threadsafe`.
+"""
+import asyncio
+from collections import deque
+
+import numpy as np
+from pymongo import ASCENDING, DESCENDING, AsyncMongoClient, IndexModel, timeout
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from pymongo.monitoring import ConnectionPoolListener
+
+
+# ==========================
+# Connection pool metrics
+# ==========================
+class PoolMetrics(ConnectionPoolListener):
+    """Connections open and in use, checkouts, and how long a checkout waited for a connection."""
+
+    def __init__(self, samples=1000):
+        self.open = 0
+        self.in_use = 0
+        self.max_in_use = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.pool_clears = 0
+        self._waits = deque(maxlen=samples)  # seconds
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self.pool_clears += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self.open += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.open -= 1
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self.checkout_failures += 1
+
+    def connection_checked_out(self, event):
+        self.checkouts += 1
+        self.in_use += 1
+        self.max_in_use = max(self.max_in_use, self.in_use)
+        if getattr(event, "duration", None) is not None:
+            self._waits.append(event.duration)
+
+    def connection_checked_in(self, event):
+        self.in_use -= 1
+
+    def stats(self):
+        waits = list(self._waits)
+        return {
+            "open": self.open,
+            "in_use": self.in_use,
+            "max_in_use": self.max_in_use,
+            "checkouts": self.checkouts,
+            "checkout_failures": self.checkout_failures,
+            "pool_clears": self.pool_clears,
+            "checkout_wait_p50_ms": float(np.percentile(waits, 50) * 1000) if waits else 0.0,
+            "checkout_wait_p99_ms": float(np.percentile(waits, 99) * 1000) if waits else 0.0,
+        }
+
+
+# ==========================
+# Game totals
+# ==========================
+# running totals of the players on every game document, changed with $inc by every buy-in
+# and end (see bot.buy_chips and bot.set_chips_end) instead of summing the players each time
+GAME_TOTALS = {
+    "total_bought": 0,
+    "total_chips_end": 0,
+    "unfinished_players": 0,  # players without end chips
+}
+
+
+def game_totals(players):
+    return {
+        "total_bought": sum(player.get("chips_bought") or 0 for player in players),
+        "total_chips_end": sum(player.get("chips_end") or 0 for player in players),
+        "unfinished_players": sum(player.get("chips_end") is None for player in players),
+    }
+
+
+# ==========================
+# Indexes
+# ==========================
+# the indexes behind every query of the bot, created at startup (see ensure_indexes)
+INDEXES = {
+    'games': [
+        # loading a chat's session (its active game) - and at most one active game per chat
+        IndexModel([("chat_id", ASCENDING)], name="one_active_game_per_chat", unique=True,
+                   partialFilterExpression={"status": "active"}),
+        # history and stats: the games of a chat, newest first (history pages are keyed by _id)
+        IndexModel([("chat_id", ASCENDING), ("_id", DESCENDING)], name="chat_games_newest_first"),
+    ],
+    'players': [
+        # loading a chat's session (the players of its game), and one player per name in a game
+        IndexModel([("chat_id", ASCENDING), ("game_id", ASCENDING), ("name", ASCENDING)], name="player_in_game",
+                   unique=True),
+        # the players of a game in the player_stats pipeline ($lookup)
+        IndexModel([("game_id", ASCENDING), ("chips_end", ASCENDING)], name="game_players_by_chips_end"),
+    ],
+    'player_stats': [
+        # /stats, and the key apply_pending_stats merges on
+        IndexModel([("chat_id", ASCENDING), ("name", ASCENDING)], name="player_stats_by_chat", unique=True),
+    ],
+    'detection_cache': [
+        # DetectionCache.load: the newest photos
+        IndexModel([("created_at", DESCENDING)], name="detection_cache_by_date"),
+    ],
+}
+
+
+# ==========================
+# Player statistics
+# ==========================
+# player_stats holds one document per player in a chat (chat_id, name, total_profit, games_played,
+# first_place_wins, total_rank) over the chat's finished games, so /stats is one indexed read.
+def player_stats_pipeline(games_match):
+    """
+    Aggregation over the games matching `games_match`: the profit of every player in every
+    game, the rank in the game by profit ($setWindowFields), then the totals per player.
+    """
+    return [
+        {"$match": games_match},
+        {"$lookup": {"from": "players", "localField": "_id", "foreignField": "game_id", "as": "player"}},
+        {"$unwind": "$player"},
+        {"$project": {
+            "_id": 0,
+            "chat_id": 1,
+            "game_id": "$_id",
+            "player_id": "$player._id",
+            "name": "$player.name",
+            "profit": {"$subtract": [{"$ifNull": ["$player.chips_end", 0]}, {"$ifNull": ["$player.chips_bought", 0]}]},
+        }},
+        {"$setWindowFields": {
+            "partitionBy": "$game_id",
+            "sortBy": {"profit": -1, "player_id": 1},
+            "output": {"rank": {"$documentNumber": {}}},
+        }},
+        {"$group": {
+            "_id": {"chat_id": "$chat_id", "name": "$name"},
+            "total_profit": {"$sum": "$profit"},
+            "games_played": {"$sum": 1},
+            "first_place_wins": {"$sum": {"$cond": [{"$eq": ["$rank", 1]}, 1, 0]}},
+            "total_rank": {"$sum": "$rank"},
+        }},
+        {"$project": {
+            "_id": 0,
+            "chat_id": "$_id.chat_id",
+            "name": "$_id.name",
+            "total_profit": 1,
+            "games_played": 1,
+            "first_place_wins": 1,
+            "total_rank": 1,
+        }},
+    ]
+
+
+# ==========================
+# Query audit
+# ==========================
+# the fields /history shows (not the cards or totals of the games)
+HISTORY_FIELDS = {"start_date": 1, "end_date": 1, "ranking": 1}
+
+
+def audited_queries(chat_id, game_id, history_page_size):
+    """ (שם, פקודת explain) לכל שאילתה של הבוט, עם מזהים אמיתיים מהמסד """
+    return [
+        ("active game", {"find": "games", "filter": {"chat_id": chat_id, "status": "active"}}),
+        ("chat history", {"find": "games", "filter": {"chat_id": chat_id, "_id": {"$lt": game_id}}, "sort": {"_id": -1},
+                          "projection": HISTORY_FIELDS, "limit": history_page_size + 1}),  # see history_page
+        ("game players", {"find": "players", "filter": {"chat_id": chat_id, "game_id": game_id}}),
+        ("player stats", {"find": "player_stats", "filter": {"chat_id": chat_id}, "sort": {"total_profit": -1}}),
+        ("game player stats", {"aggregate": "games", "cursor": {},
+                               "pipeline": player_stats_pipeline({"_id": game_id, "status": "inactive"})}),
+    ]
+
+
+def find_in_explain(document, key):
+    """ the first value of `key` in an explain output, depth first, skipping rejected plans """
+    if isinstance(document, dict):
+        if key in document:
+            return document[key]
+        children = [value for child_key, value in document.items() if child_key != "rejectedPlans"]
+    elif isinstance(document, list):
+        children = document
+    else:
+        return None
+    for child in children:
+        found = find_in_explain(child, key)
+        if found is not None:
+            return found
+    return None
+
+
+def plan_stages(plan):
+    """ the stage names of a winning plan, outermost first """
+    if isinstance(plan, list):
+        return [stage for child in plan for stage in plan_stages(child)]
+    if not isinstance(plan, dict):
+        return []
+    stages = [plan["stage"]] if isinstance(plan.get("stage"), str) else []
+    for key, value in plan.items():
+        if isinstance(value, (dict, list)):
+            stages += plan_stages(value)
+    return stages
+
+
+# ==========================
+# Repository
+# ==========================
+class GameRepository:
+    def __init__(self, uri, database_name='poker_bot', max_pool_size=20, min_pool_size=1, max_idle_ms=60000,
+                 timeout_ms=5000, slow_timeout_ms=30000):
+        self.uri = uri
+        self.database_name = database_name
+        self.max_pool_size = max_pool_size
+        self.min_pool_size = min_pool_size
+        self.max_idle_ms = max_idle_ms
+        self.timeout_ms = timeout_ms
+        self.slow_timeout_ms = slow_timeout_ms  # whole-history aggregations and index builds
+        self.pool = PoolMetrics()
+        self._client = None
+        self._stats_rebuilt = set()  # chats whose statistics get_player_stats computed from their old games
+        self._stats_locks = {}  # chat_id -> lock held while apply_pending_stats updates the chat's statistics
+
+    @property
+    def database(self):
+        """ מסד הנתונים; הלקוח נוצר בשימוש הראשון, לא בזמן הטעינה """
+        if self._client is None:
+            print(f"Connecting to MongoDB at {self.uri}")
+            self._client = AsyncMongoClient(
+                self.uri,
+                maxPoolSize=self.max_pool_size,
+                minPoolSize=self.min_pool_size,
+                maxIdleTimeMS=self.max_idle_ms,
+                timeoutMS=self.timeout_ms,
+                event_listeners=[self.pool],
+            )
+        return self._client[self.database_name]
+
+    async def ping(self):
+        await self.database.command("ping")
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    # --- sessions ---
+    async def load_active_game(self, chat_id, create=True):
+        """ (המשחק הפעיל של הצ'אט, השחקנים שלו); כשאין משחק פעיל נוצר חדש, או None אם create כבוי """
+        games = self.database['games']
+        query = {"chat_id": chat_id, "status": "active"}
+        game = await games.find_one(query)
+        if game is None:
+            if not create:
+                return None
+            game = {
+                "chat_id": chat_id,
+                "start_date": None,
+                "end_date": None,
+                "status": "active",
+                **GAME_TOTALS,
+            }
+            try:
+                await games.insert_one(game)
+            except DuplicateKeyError:
+                # another process created the game first (one_active_game_per_chat)
+                game = await games.find_one(query)
+        players = await self.database['players'].find({"chat_id": chat_id, "game_id": game["_id"]}).to_list()
+        if any(field not in game for field in GAME_TOTALS):
+            # a game from before the running totals: computed once from its players
+            totals = game_totals(players)
+            await games.update_one({"_id": game["_id"]}, {"$set": totals})
+            game.update(totals)
+        return game, players
+
+    async def write_game(self, game_id, game_update, player_requests):
+        """
+        Writes the changes of one session: an update of the game and one bulk write of its
+        players, in one transaction, so the game's running totals never count a player change
+        that was not written (and a failed write wrote nothing).
+        """
+        games, players = self.database['games'], self.database['players']
+
+        async def write(session):
+            if game_update:
+                await games.update_one({"_id": game_id}, game_update, session=session)
+            if player_requests:
+                await players.bulk_write(player_requests, ordered=True, session=session)
+
+        async with self._client.start_session() as session:
+            await session.with_transaction(write)
+
+    # --- player statistics ---
+    async def rebuild_player_stats(self, chat_id):
+        """ מחשבת מחדש את הסטטיסטיקות של כל השחקנים בצ'אט מכל המשחקים שהסתיימו """
+        with timeout(self.slow_timeout_ms / 1000):
+            await self.database['games'].aggregate(player_stats_pipeline({"chat_id": chat_id, "status": "inactive"}) + [
+                {"$merge": {"into": "player_stats", "on": ["chat_id", "name"],
+                            "whenMatched": "replace", "whenNotMatched": "insert"}},
+            ])
+
+    async def apply_pending_stats(self, chat_id):
+        """
+        Adds the games of the chat that ended since the last update (marked `stats_pending`
+        when they ended) to the players' statistics. Only a single game that just ended is
+        added by an incremental $merge; when an earlier attempt did not finish (a game still
+        pending, or marked "applying" by an attempt that failed half-way), or the chat has no
+        statistics yet, the chat is rebuilt from all its games instead, which is idempotent.
+        Calls for the same chat run one at a time in this process.
+        """
+        async with self._stats_locks.setdefault(chat_id, asyncio.Lock()):
+            games = self.database['games']
+            pending = await games.find({"chat_id": chat_id, "status": "inactive", "stats_pending": {"$exists": True}},
+                                       {"stats_pending": 1}).to_list()
+            if not pending:
+                return
+            has_stats = await self.database['player_stats'].find_one({"chat_id": chat_id}, {"_id": 1}) is not None
+            if len(pending) == 1 and pending[0]["stats_pending"] is True and has_stats:
+                game_id = pending[0]["_id"]
+                # claimed atomically: another process that selected the same game does not merge it again
+                claimed = await games.find_one_and_update({"_id": game_id, "stats_pending": True},
+                                                          {"$set": {"stats_pending": "applying"}})
+                if claimed is None:
+                    return
+                add = {field: {"$add": [f"${field}", f"$$new.{field}"]}
+                       for field in ("total_profit", "games_played", "first_place_wins", "total_rank")}
+                await games.aggregate(player_stats_pipeline({"_id": game_id, "status": "inactive"}) + [
+                    {"$merge": {"into": "player_stats", "on": ["chat_id", "name"],
+                                "whenMatched": [{"$set": add}], "whenNotMatched": "insert"}},
+                ])
+            else:
+                await self.rebuild_player_stats(chat_id)
+            await games.update_many({"_id": {"$in": [game["_id"] for game in pending]}},
+                                    {"$unset": {"stats_pending": ""}})
+
+    async def get_player_stats(self, chat_id):
+        """ הסטטיסטיקות של השחקנים בצ'אט, מהרווח הגבוה לנמוך """
+        try:
+            await self.apply_pending_stats(chat_id)
+        except Exception as e:
+            print(f"Player stats update failed for chat {chat_id}: {e}")  # shown as they are, retried next time
+        player_stats = self.database['player_stats']
+        players = await player_stats.find({"chat_id": chat_id}).sort("total_profit", -1).to_list()
+        if not players and chat_id not in self._stats_rebuilt:
+            # games that ended before the statistics were kept, computed once per chat and process
+            self._stats_rebuilt.add(chat_id)
+            if await self.database['games'].find_one({"chat_id": chat_id, "status": "inactive"}, {"_id": 1}):
+                await self.rebuild_player_stats(chat_id)
+                players = await player_stats.find({"chat_id": chat_id}).sort("total_profit", -1).to_list()
+        return players
+
+    # --- history and summary ---
+    async def history_page(self, chat_id, page_size, skip=0, before=None, after=None):
+        """
+        עמוד של משחקי הצ'אט מהחדש לישן, ו-True אם יש עמוד ישן יותר.
+        The page starts after the game `before` or ends before the game `after` (game _ids,
+        read from the chat_games_newest_first index), or skips `skip` games of the newest.
+        """
+        games = self.database['games']
+        query = {"chat_id": chat_id}
+        if after is not None:
+            query["_id"] = {"$gt": after}
+            page = await games.find(query, HISTORY_FIELDS).sort("_id", ASCENDING).limit(page_size).to_list()
+            return page[::-1], True
+        if before is not None:
+            query["_id"] = {"$lt": before}
+        cursor = games.find(query, HISTORY_FIELDS).sort("_id", DESCENDING).skip(skip).limit(page_size + 1)
+        page = await cursor.to_list()
+        return page[:page_size], len(page) > page_size
+
+    async def counts(self):
+        """ מספר המשחקים, הצ'אטים והשחקנים """
+        games = self.database['games']
+        return {
+            "total_games": await games.count_documents({}),
+            "total_chats": len(await games.distinct("chat_id")),
+            "total_players": await self.database['players'].count_documents({}),
+        }
+
+    # --- indexes and query audit ---
+    async def ensure_indexes(self):
+        """ יוצרת את האינדקסים שחסרים; אינדקס קיים נשאר כמו שהוא """
+        with timeout(self.slow_timeout_ms / 1000):
+            for collection_name, indexes in INDEXES.items():
+                for index in indexes:
+                    try:
+                        await self.database[collection_name].create_indexes([index])
+                    except OperationFailure as e:
+                        # a unique index cannot be built while the collection holds duplicates
+                        print(f"Index {index.document['name']} on {collection_name} was not created: {e}")
+
+    async def audit_queries(self, slow_query_ms, history_page_size):
+        """
+        Runs explain on the bot's queries against the newest game, and reports every query
+        that scans a whole collection (COLLSCAN) or takes at least `slow_query_ms`.
+        `history_page_size` is the page size /history reads with (history_page).
+        """
+        game = await self.database['games'].find_one(sort=[("_id", DESCENDING)])
+        if game is None:
+            print("Query audit: no games yet")
+            return []
+
+        report = []
+        for query_name, command in audited_queries(game["chat_id"], game["_id"], history_page_size):
+            explain = await self.database.command("explain", command, verbosity="executionStats")
+            stats = find_in_explain(explain, "executionStats") or {}
+            entry = {
+                "query": query_name,
+                "stages": plan_stages(find_in_explain(explain, "winningPlan")),
+                "docs_examined": stats.get("totalDocsExamined"),
+                "returned": stats.get("nReturned"),
+                "ms": stats.get("executionTimeMillis"),
+            }
+            entry["collscan"] = "COLLSCAN" in entry["stages"]
+            report.append(entry)
+            if entry["collscan"] or (entry["ms"] or 0) >= slow_query_ms:
+                print(f"Query audit: {query_name} - {' <- '.join(entry['stages'])}, "
+                      f"{entry['docs_examined']} examined for {entry['returned']} returned, {entry['ms']} ms")
+        print(f"Query audit: {sum(entry['collscan'] for entry in report)} of {len(report)} queries scan a collection")
+        return report
+
+    def stats(self):
+        return {
+            "max_pool_size": self.max_pool_size,
+            "timeout_ms": self.timeout_ms,
+            "connected": self._client is not None,
+            **self.pool.stats(),
+        }
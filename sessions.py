@@ -0,0 +1,342 @@
+"""
+Per-chat session cache for the bot: the active game of every chat and its players, kept
+in memory so that handling a message does not cost MongoDB round-trips.
+
+`SessionStore.get(chat_id)` returns the chat's `GameSession`, loaded from MongoDB on a
+miss (creating the active game if there is none). From then on the session is the
+authority for that game: handlers read it and record their changes on it (`set_game`,
+`increment_game`, `add_player`, `set_player`, `increment_player`, `clear_players`), and the
+store writes them back behind the handlers - also for a session that was evicted or ended
+meanwhile - coalesced into one write per collection and session:
+
+- every `flush_interval` seconds for the sessions that changed, and on `close`;
+- right away where other readers depend on them (`flush`, `end_game`).
+
+Players are written as upserts on their unique key (chat_id, game_id, name), and counters
+such as the chips bought as $inc, so a player added by two messages - or two processes -
+at once is stored once and keeps both buy-ins. The game and its players are written in
+one transaction, so a flush that fails wrote nothing: it keeps its changes, merged under
+any newer ones, and the next flush writes them again. $inc amounts are therefore added
+once, unless the commit reached the server but every retry of it failed. A session is only
+evicted (idle for `idle_timeout` seconds) once all of its changes are written; a hard
+kill of the process loses at most the last `flush_interval` of changes.
+"""
+import asyncio
+import time
+from datetime import datetime
+
+from pymongo import DeleteMany, UpdateOne
+
+UNSET = object()  # a field value that removes the field
+
+
+class _Changes:
+    """
+    The changes of one document not written yet: values to set (`values`, UNSET removes
+    the field), amounts to add (`increments`) and values for a new document (`defaults`).
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.increments = {}
+        self.defaults = {}
+
+    def __bool__(self):
+        return bool(self.values or self.increments or self.defaults)
+
+    def set(self, fields):
+        self.values.update(fields)
+        for field in fields:
+            self.increments.pop(field, None)
+
+    def increment(self, amounts, document):
+        """Adds `amounts`; `document` already holds the new values."""
+        for field, amount in amounts.items():
+            if field in self.values:
+                self.values[field] = document[field]  # still to be set, to the new value
+            else:
+                self.increments[field] = self.increments.get(field, 0) + amount
+
+    def merge_older(self, older):
+        """Puts back the changes of a failed write under these newer ones."""
+        for field, value in older.values.items():
+            if field in self.values:
+                continue
+            if field in self.increments:
+                self.values[field] = value + self.increments.pop(field)
+            else:
+                self.values[field] = value
+        for field, amount in older.increments.items():
+            if field not in self.values:  # a newer value already includes the amount
+                self.increments[field] = self.increments.get(field, 0) + amount
+        self.defaults = {**older.defaults, **self.defaults}
+
+    def update_document(self):
+        """$set/$unset/$inc/$setOnInsert update (empty when there are no changes)"""
+        update = {}
+        values = {field: value for field, value in self.values.items() if value is not UNSET}
+        removed = {field: "" for field, value in self.values.items() if value is UNSET}
+        defaults = {field: value for field, value in self.defaults.items()
+                    if field not in self.values and field not in self.increments}
+        if values:
+            update["$set"] = values
+        if removed:
+            update["$unset"] = removed
+        if self.increments:
+            update["$inc"] = dict(self.increments)
+        if defaults:
+            update["$setOnInsert"] = defaults
+        return update
+
+
+def _apply(document, fields):
+    for field, value in fields.items():
+        if value is UNSET:
+            document.pop(field, None)
+        else:
+            document[field] = value
+
+
+class GameSession:
+    """
+    The active game of one chat (`game`, the stored document) and its players by name.
+    `on_change` is called with the session whenever a change is recorded.
+    """
+
+    def __init__(self, chat_id, game, players, on_change=None):
+        self.chat_id = chat_id
+        self.game = game
+        self.players = {player["name"]: player for player in players}
+        self.on_change = on_change
+        self.last_used = time.monotonic()
+        self.hand_state = None  # the current hand (equity.HandState), in memory only - gone with the session
+        self.flush_lock = asyncio.Lock()  # one write of the session at a time, in order
+        self._game_changes = _Changes()
+        self._player_changes = {}  # player name -> _Changes
+        self._players_deleted = False  # delete the stored players before the player changes
+
+    @property
+    def game_id(self):
+        return self.game["_id"]
+
+    @property
+    def dirty(self):
+        return bool(self._game_changes or self._player_changes or self._players_deleted)
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change(self)
+
+    def set_game(self, **fields):
+        _apply(self.game, fields)
+        self._game_changes.set(fields)
+        self._changed()
+
+    def increment_game(self, **amounts):
+        for field, amount in amounts.items():
+            self.game[field] = (self.game.get(field) or 0) + amount
+        self._game_changes.increment(amounts, self.game)
+        self._changed()
+
+    def get_player(self, name):
+        """ נתוני שחקן במשחק לפי שם, או None """
+        return self.players.get(name.lower())
+
+    def add_player(self, name, **fields):
+        """ מוסיפה שחקן למשחק; השדות נשמרים רק אם השחקן לא נשמר כבר על ידי כותב אחר """
+        player = {"chat_id": self.chat_id, "game_id": self.game_id, "name": name.lower(), **fields}
+        self.players[player["name"]] = player
+        self._player_changes.setdefault(player["name"], _Changes()).defaults.update(fields)
+        self._changed()
+        return player
+
+    def set_player(self, player, **fields):
+        _apply(player, fields)
+        self._player_changes.setdefault(player["name"], _Changes()).set(fields)
+        self._changed()
+
+    def increment_player(self, player, **amounts):
+        for field, amount in amounts.items():
+            player[field] = (player.get(field) or 0) + amount
+        self._player_changes.setdefault(player["name"], _Changes()).increment(amounts, player)
+        self._changed()
+
+    def clear_players(self):
+        """ מוחקת את כל השחקנים של המשחק """
+        self.players = {}
+        self._player_changes = {}
+        self._players_deleted = True
+        self._changed()
+
+    def take_changes(self):
+        """The changes not written yet, which are then cleared; None when there are none."""
+        if not self.dirty:
+            return None
+        changes = (self._game_changes, self._player_changes, self._players_deleted)
+        self._game_changes, self._player_changes, self._players_deleted = _Changes(), {}, False
+        return changes
+
+    def restore_changes(self, changes):
+        """Puts back changes whose write failed, under the changes recorded since."""
+        game_changes, player_changes, players_deleted = changes
+        self._game_changes.merge_older(game_changes)
+        if not self._players_deleted:  # else the players were cleared since, their older changes are void
+            for name, fields in player_changes.items():
+                self._player_changes.setdefault(name, _Changes()).merge_older(fields)
+            self._players_deleted = players_deleted
+        self._changed()
+
+
+class SessionStore:
+    """
+    The sessions of all chats, read and written through `repository`
+    (repository.GameRepository: load_active_game and write_game).
+    """
+
+    def __init__(self, repository, flush_interval=1.0, idle_timeout=1800):
+        self.repository = repository
+        self.flush_interval = flush_interval
+        self.idle_timeout = idle_timeout
+        self._sessions = {}
+        self._dirty = set()  # sessions with changes to write, including ones no longer in _sessions
+        self._locks = {}  # chat_id -> lock held while the session is loaded
+        self._task = None
+        self.hits = 0
+        self.loads = 0
+        self.flushes = 0
+        self.flush_failures = 0
+        self.evictions = 0
+
+    async def get(self, chat_id, create=True):
+        """
+        מחזירה את הסשן של המשחק הפעיל בצ'אט, וטוענת אותו מהמסד אם אינו בזיכרון.
+        With `create` a new active game is created when the chat has none, otherwise None is returned.
+        """
+        session = self._sessions.get(chat_id)
+        if session is None:
+            lock = self._locks.setdefault(chat_id, asyncio.Lock())
+            async with lock:
+                session = self._sessions.get(chat_id) or self._unwritten_session(chat_id)
+                if session is None:
+                    loaded = await self.repository.load_active_game(chat_id, create)
+                    if loaded is None:
+                        return None
+                    game, players = loaded
+                    session = GameSession(chat_id, game, players, on_change=self._dirty.add)
+                    self.loads += 1
+                else:
+                    self.hits += 1
+                self._sessions[chat_id] = session
+        else:
+            self.hits += 1
+        session.last_used = time.monotonic()
+        return session
+
+    def _unwritten_session(self, chat_id):
+        """An evicted session of the chat's active game whose changes are not written yet (newer than MongoDB)."""
+        for session in self._dirty:
+            if session.chat_id == chat_id and session.game.get("status") == "active":
+                return session
+        return None
+
+    async def end_game(self, chat_id, **fields):
+        """
+        מסמנת את המשחק הפעיל כלא פעיל, כותבת אותו מיד ומסירה את הסשן (ההודעה הבאה פותחת משחק חדש).
+        `fields` are set on the game in the same write. Returns the ended game, or None when
+        the chat has no active game. When the write fails the game stays active and the error
+        is raised.
+        """
+        session = await self.get(chat_id, create=False)
+        if session is None:
+            return None
+        session.set_game(status="inactive", end_date=datetime.now(), **fields)
+        try:
+            await self.flush(session)
+        except Exception:
+            session.set_game(status="active", end_date=None, **{field: UNSET for field in fields})
+            raise
+        if self._sessions.get(chat_id) is session:
+            del self._sessions[chat_id]
+        return session.game
+
+    async def flush(self, session):
+        """Writes the session's changes now; on failure they are kept for the next flush and the error is raised."""
+        async with session.flush_lock:
+            changes = session.take_changes()
+            self._dirty.discard(session)  # added back by a change recorded meanwhile, or by a failed write
+            if changes is None:
+                return
+            try:
+                await self._write(session.chat_id, session.game_id, changes)
+            except Exception:
+                session.restore_changes(changes)
+                self.flush_failures += 1
+                raise
+            self.flushes += 1
+
+    async def flush_chat(self, chat_id):
+        """ כותבת למסד את השינויים של הצ'אט, אם יש, לפני קריאת המשחקים שלו מהמסד """
+        for session in [session for session in self._dirty if session.chat_id == chat_id]:
+            await self.flush(session)
+
+    async def _write(self, chat_id, game_id, changes):
+        game_changes, player_changes, players_deleted = changes
+        requests = [DeleteMany({"chat_id": chat_id, "game_id": game_id})] if players_deleted else []
+        # upserts on the unique player_in_game key: a player stored meanwhile is updated, not duplicated
+        requests += [UpdateOne({"chat_id": chat_id, "game_id": game_id, "name": name}, fields.update_document(),
+                               upsert=True)
+                     for name, fields in player_changes.items()]
+        await self.repository.write_game(game_id, game_changes.update_document(), requests)
+
+    async def flush_all(self):
+        for session in list(self._dirty):
+            try:
+                await self.flush(session)
+            except Exception as e:
+                print(f"Session flush failed for chat {session.chat_id}, will retry: {e}")
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        for chat_id, session in list(self._sessions.items()):
+            lock = self._locks.get(chat_id)
+            if (session.dirty or session.flush_lock.locked() or now - session.last_used < self.idle_timeout
+                    or (lock is not None and lock.locked())):
+                continue
+            del self._sessions[chat_id]
+            self._locks.pop(chat_id, None)
+            self.evictions += 1
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush_all()
+            self._evict_idle()
+
+    def start(self):
+        """Starts the background flushes (in the running event loop)."""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def close(self):
+        """Stops the background flushes and writes everything that is left."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush_all()
+
+    def stats(self):
+        lookups = self.hits + self.loads
+        return {
+            "sessions": len(self._sessions),
+            "dirty": len(self._dirty),
+            "hits": self.hits,
+            "loads": self.loads,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "flushes": self.flushes,
+            "flush_failures": self.flush_failures,
+            "evictions": self.evictions,
+        }
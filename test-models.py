@@ -1,74 +1,249 @@
+"""
+Offline evaluation harness for the card detector.
+
+Runs one or more detector backends (detector.load_card_model: .pt or .onnx) over a
+labeled photo directory, in batches spread over worker processes, and reports per card
+class precision/recall, exact-hand accuracy, per-photo latency percentiles and throughput:
+
+    python test-models.py --images test-images --models yolov8s_playing_cards-1.pt \\
+        yolov8s_playing_cards-1.onnx --workers 2 --batch-size 4 --output evaluation.json
+
+Labels come from <images>/labels.json ({"photo.jpg": ["AS", "10C"], ...}) or, for photos
+not listed there, from the file name (e.g. "AS_KD_10C.jpg"). HEIC photos are converted
+to JPEG once, and every photo is decoded once into <images>/.cache as a .npy array, so
+repeated runs skip the conversion and the JPEG decoding.
+
+--preprocess runs every backend once per preprocessing variant (detector.preprocess_image,
+timed together with the model) and reports what each variant saves in latency and what it
+changes in accuracy against the first variant:
+
+    python test-models.py --preprocess none resize resize+crop
+"""
+import argparse
+import json
 import os
-from matplotlib.cm import ScalarMappable
-from ultralytics import YOLO
+import re
+import time
+from collections import Counter
+from functools import partial
+from multiprocessing import Pool
 
 import cv2
 import numpy as np
-from PIL import Image
+
+from detector import MODEL_IMAGE_SIZE, identify_cards, load_card_model, preprocess_image
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".heic")
+CARD_LABEL = re.compile(r"^(10|[2-9TJQKA])[CDHS]$", re.IGNORECASE)
+# variant -> (image_size, crop_table) for detector.preprocess_image
+PREPROCESSING = {
+    "none": (0, False),
+    "resize": (MODEL_IMAGE_SIZE, False),
+    "crop": (0, True),
+    "resize+crop": (MODEL_IMAGE_SIZE, True),
+}
 
 # נתיב הבסיס: מחושב אוטומטית לפי מיקום bot.py
 base_dir = os.path.dirname(os.path.abspath(__file__))
-os.chdir(base_dir)  # Set the current working directory to base_dir
-
-def preprocess_card_image(image_path):
-    # טוען את התמונה המקורית
-    image = cv2.imread(image_path)
-    
-    # שלב 1: הפיכת התמונה לגווני אפור
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    
-    # שלב 2: הגברת הניגודיות באמצעות histogram equalization
-    enhanced_gray = cv2.equalizeHist(gray)
-    
-    # שלב 3: החלת סף להדגשת הקלפים, תוך שמירה על פרטים
-    _, thresh = cv2.threshold(enhanced_gray, 150, 255, cv2.THRESH_BINARY_INV)
-    
-    # שלב 4: הוספת מעט מסגרת מסביב לקלף
-    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
-    bordered = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, kernel, iterations=2)
-    
-    # שלב 5: נקה רעש חיצוני (במיוחד אם יש אזורים בהירים קטנים בתמונה)
-    clean_image = cv2.medianBlur(bordered, 5)
-    
-    return clean_image
-
-# Load a model
-# data_path = os.path.join(os.path.expanduser("~"), "Nutrino/datasets/playing-cards-trainning-set/data.yaml")
-# model = YOLO("yolov8n.yaml")  # build a new model from scratch
-# results = model.train(data=data_path, epochs=3)  # train the model
-# results = model.val()  # evaluate model performance on the validation set
-# success = YOLO("yolov8n.pt").export(format="onnx")  # export a model to ONNX format
-
-# מעבר על כל קובצי HEIC בתיקייה
-#model_1 = YOLO("./yolov8m_synthetic.pt")
-model_2 = YOLO("./yolov8s_playing_cards-1.pt")
-#model_3 = YOLO("./yolov8s_playing_cards-2.pt")
-
-for filename in os.listdir(os.path.join(base_dir,'test-images')):
-    if filename.find("processed") != -1 or filename.find(".jpg") == -1:
-        continue
-    heic_path = os.path.join(os.path.join(base_dir,'test-images'), filename)
-    jpg_path = heic_path.replace(".HEIC", ".jpg")
-
-    if not os.path.exists(jpg_path):
-        with Image.open(heic_path) as img:
+
+
+# ==========================
+# Photos, labels and cache
+# ==========================
+def load_labels(images_dir):
+    """תוויות הקלפים של כל תמונה: מ-labels.json, ואחרת משם הקובץ"""
+    labels_path = os.path.join(images_dir, "labels.json")
+    listed = {}
+    if os.path.exists(labels_path):
+        with open(labels_path) as f:
+            listed = json.load(f)
+
+    labels = {}
+    for filename in sorted(os.listdir(images_dir)):
+        if not filename.lower().endswith(IMAGE_EXTENSIONS) or "processed" in filename:
+            continue
+        if filename in listed:
+            labels[filename] = sorted(label.upper() for label in listed[filename])
+        else:
+            tokens = re.split(r"[_\-\s]+", os.path.splitext(filename)[0])
+            cards = [token.upper() for token in tokens if CARD_LABEL.match(token)]
+            if cards:
+                labels[filename] = sorted(cards)
+    return labels
+
+
+def cached_array(images_dir, filename):
+    """
+    Path of the decoded BGR array of a photo in the cache, converting HEIC to JPEG and
+    decoding only when the photo changed since the cached copy was written.
+    """
+    cache_dir = os.path.join(images_dir, ".cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    source = os.path.join(images_dir, filename)
+    stat = os.stat(source)
+    cached = os.path.join(cache_dir, f"{filename}.{stat.st_size}.{int(stat.st_mtime)}.npy")
+    if os.path.exists(cached):
+        return cached
+
+    if filename.lower().endswith(".heic"):
+        from PIL import Image
+        from pillow_heif import register_heif_opener
+
+        register_heif_opener()
+        jpg_path = os.path.join(cache_dir, os.path.splitext(filename)[0] + ".jpg")
+        with Image.open(source) as img:
             img.convert("RGB").save(jpg_path, "JPEG")
-       
-    # קריאה לתמונה והכנה
-    #processed_image = preprocess_card_image(jpg_path)
-    #processed_path = jpg_path.replace(".jpg", "_processed.jpg")
-    #cv2.imwrite(processed_path, processed_image)
-
-    #results1 = model_1(jpg_path)
-    results2 = model_2(jpg_path,)
-    #results3 = model_2(processed_path)
-
-    # הדפסת זיהויים עבור קלפים בלבד
-    for i, results in enumerate([results2], 1):
-        identified = set()
-        for result in results:
-            if result.boxes:
-                for box in result.boxes:
-                    card_label = result.names[int(box.cls)]
-                    identified.add(card_label)
-        print(f"{filename}: {identified}")
+        source = jpg_path
+
+    image = cv2.imread(source)
+    if image is None:
+        raise ValueError(f"Cannot read {source}")
+    np.save(cached, image)
+    return cached
+
+
+# ==========================
+# Workers
+# ==========================
+worker_model = None
+
+
+def init_worker(model_path):
+    global worker_model
+    worker_model = load_card_model(model_path)
+    worker_model(np.zeros((640, 640, 3), dtype=np.uint8))  # warm-up
+
+
+def detect_batch(batch, image_size=0, crop_table=False):
+    """Runs one batch of (filename, cached array) through preprocessing and the model in a single call."""
+    images = [np.load(path) for _, path in batch]
+    start = time.perf_counter()
+    results = worker_model([preprocess_image(image, image_size, crop_table) for image in images])
+    predictions = [identify_cards(result, image) for result, image in zip(results, images)]
+    elapsed = time.perf_counter() - start
+    return [(filename, cards, elapsed / len(batch)) for (filename, _), cards in zip(batch, predictions)]
+
+
+def run_backend(pool, photos, batch_size, preprocessing):
+    """Predictions and per-photo latency (batch time / batch size) of one variant, and the wall time."""
+    batches = [photos[i:i + batch_size] for i in range(0, len(photos), batch_size)]
+    image_size, crop_table = PREPROCESSING[preprocessing]
+    start = time.perf_counter()
+    rows = pool.imap_unordered(partial(detect_batch, image_size=image_size, crop_table=crop_table), batches)
+    outputs = [row for batch_rows in rows for row in batch_rows]
+    wall_time = time.perf_counter() - start
+    return {filename: (cards, latency) for filename, cards, latency in outputs}, wall_time
+
+
+# ==========================
+# Metrics
+# ==========================
+def evaluate(labels, predictions, wall_time):
+    true_positives, false_positives, false_negatives = Counter(), Counter(), Counter()
+    exact = 0
+    for filename, truth in labels.items():
+        predicted = set(predictions[filename][0])
+        truth = set(truth)
+        exact += predicted == truth
+        for card in predicted & truth:
+            true_positives[card] += 1
+        for card in predicted - truth:
+            false_positives[card] += 1
+        for card in truth - predicted:
+            false_negatives[card] += 1
+
+    per_class = {}
+    for card in sorted(set(true_positives) | set(false_positives) | set(false_negatives)):
+        tp, fp, fn = true_positives[card], false_positives[card], false_negatives[card]
+        per_class[card] = {
+            "precision": tp / (tp + fp) if tp + fp else 0.0,
+            "recall": tp / (tp + fn) if tp + fn else 0.0,
+            "support": tp + fn,
+        }
+
+    tp, fp, fn = sum(true_positives.values()), sum(false_positives.values()), sum(false_negatives.values())
+    latencies = [latency for _, latency in predictions.values()]
+    return {
+        "photos": len(labels),
+        "exact_hand_accuracy": exact / len(labels) if labels else 0.0,
+        "precision": tp / (tp + fp) if tp + fp else 0.0,
+        "recall": tp / (tp + fn) if tp + fn else 0.0,
+        "latency_p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "latency_p90_ms": float(np.percentile(latencies, 90) * 1000),
+        "latency_p99_ms": float(np.percentile(latencies, 99) * 1000),
+        "photos_per_second": len(labels) / wall_time,
+        "per_class": per_class,
+        "predictions": {filename: cards for filename, (cards, _) in predictions.items()},
+    }
+
+
+def print_metrics(name, metrics, labels, per_class):
+    print(f"\n{name}: exact hands {metrics['exact_hand_accuracy']:.1%}, "
+          f"precision {metrics['precision']:.1%}, recall {metrics['recall']:.1%}, "
+          f"p50/p90/p99 {metrics['latency_p50_ms']:.1f}/{metrics['latency_p90_ms']:.1f}/"
+          f"{metrics['latency_p99_ms']:.1f} ms, {metrics['photos_per_second']:.1f} photos/s")
+    if per_class:
+        for card, stats in metrics["per_class"].items():
+            print(f"  {card:<4} precision {stats['precision']:.2f} recall {stats['recall']:.2f} "
+                  f"(support {stats['support']})")
+    for filename, truth in labels.items():
+        predicted = metrics["predictions"][filename]
+        if set(predicted) != set(truth):
+            print(f"  {filename}: expected {truth}, detected {predicted}")
+
+
+def print_preprocessing_savings(report, models, variants):
+    """Latency saved and accuracy change of every preprocessing variant against the first one."""
+    print(f"\n{'model':<36} {'variant':<12} {'p50 saved':>10} {'p90 saved':>10} {'Δexact':>8} {'Δrecall':>8}")
+    for model_path in models:
+        model = os.path.basename(model_path)
+        reference = report[f"{model} [{variants[0]}]"]
+        for variant in variants[1:]:
+            metrics = report[f"{model} [{variant}]"]
+            print(f"{model:<36} {variant:<12} "
+                  f"{1 - metrics['latency_p50_ms'] / reference['latency_p50_ms']:>10.1%} "
+                  f"{1 - metrics['latency_p90_ms'] / reference['latency_p90_ms']:>10.1%} "
+                  f"{metrics['exact_hand_accuracy'] - reference['exact_hand_accuracy']:>+8.1%} "
+                  f"{metrics['recall'] - reference['recall']:>+8.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate card detector backends on labeled photos")
+    parser.add_argument("--images", default=os.path.join(base_dir, "test-images"))
+    parser.add_argument("--models", nargs="+", default=[os.path.join(base_dir, "yolov8s_playing_cards-1.pt")])
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--preprocess", nargs="+", choices=list(PREPROCESSING), default=["none"],
+                        help="preprocessing variants to run, the first one is the reference")
+    parser.add_argument("--per-class", action="store_true", help="print precision/recall for every card class")
+    parser.add_argument("--output", help="write all metrics and predictions as JSON")
+    args = parser.parse_args()
+
+    labels = load_labels(args.images)
+    if not labels:
+        parser.error(f"no labeled photos in {args.images}")
+    photos = [(filename, cached_array(args.images, filename)) for filename in labels]
+    print(f"{len(photos)} labeled photos")
+
+    report = {}
+    for model_path in args.models:
+        with Pool(args.workers, initializer=init_worker, initargs=(model_path,)) as pool:
+            for preprocessing in args.preprocess:
+                predictions, wall_time = run_backend(pool, photos, args.batch_size, preprocessing)
+                name = os.path.basename(model_path)
+                if len(args.preprocess) > 1:
+                    name += f" [{preprocessing}]"
+                metrics = report[name] = evaluate(labels, predictions, wall_time)
+                print_metrics(name, metrics, labels, args.per_class)
+
+    if len(args.preprocess) > 1:
+        print_preprocessing_savings(report, args.models, args.preprocess)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved {args.output}")
+
+
+if __name__ == '__main__':
+    main()